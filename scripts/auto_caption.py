@@ -74,18 +74,25 @@ def get_parser(**parser_kwargs):
         default="cuda",
         help="specify a different torch device, e.g. 'cpu'",
     ),
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        nargs="?",
+        const=True,
+        default=1,
+        help="images captioned per generate call, higher is faster but uses more memory, e.g. 8",
+    ),
 
     return parser
 
-def load_image(raw_image, device):
+def load_image(raw_image):
     transform = transforms.Compose([
         #transforms.CenterCrop(SIZE),
         transforms.Resize((SIZE, SIZE), interpolation=InterpolationMode.BICUBIC),
         transforms.ToTensor(),
         transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225))
     ])
-    image = transform(raw_image).unsqueeze(0).to(device)
-    return image
+    return transform(raw_image)
 
 def get_out_file_name(out_dir, base_name, ext):
     return os.path.join(out_dir, f"{base_name}{ext}")
@@ -94,10 +101,6 @@ async def main(opt):
     print("starting")
     import models.blip
 
-    sample = False
-    if opt.nucleus:
-        sample = True
-
     input_dir = opt.img_dir
     print("input_dir: ", input_dir)
 
@@ -134,10 +137,10 @@ async def main(opt):
     ext = ('.jpg', '.jpeg', '.png', '.webp', '.tif', '.tga', '.tiff', '.bmp', '.gif')
 
     i = 0
+    batch = []
 
     for idx, img_file_name in enumerate(glob.iglob(os.path.join(opt.img_dir, "*.*"))):
         if img_file_name.endswith(ext):
-            caption = None
             file_ext = os.path.splitext(img_file_name)[1]
             if (file_ext in ext):
                 async with aiofiles.open(img_file_name, "rb") as input_file:
@@ -149,48 +152,67 @@ async def main(opt):
                     if not image.mode == "RGB":
                         image = image.convert("RGB")
 
-                    image = load_image(image, device=torch.device(opt.torch_device))
-
-                    if opt.nucleus:
-                        captions = blip_decoder.generate(image, sample=True, top_p=opt.q_factor)
-                    else:
-                        captions = blip_decoder.generate(image, sample=sample, num_beams=16, min_length=opt.min_length, \
-                            max_length=48, repetition_penalty=opt.q_factor)
-
-                    caption = captions[0]
-
-                    if opt.format in ["mrwho","joepenna"]:
-                        prefix = f"{i:05}@"
-                        i += 1
-                        caption = prefix+caption
-                    elif opt.format == "filename":
-                        postfix = f"_{i}"
-                        i += 1
-                        caption = caption+postfix
-
-                    if opt.format in ["txt","text","caption"]:
-                        out_base_name = os.path.splitext(os.path.basename(img_file_name))[0]
-
-                    if opt.format in ["txt","text"]:
-                        out_file = get_out_file_name(opt.out_dir, out_base_name, ".txt")
-
-                    if opt.format in ["caption"]:
-                        out_file = get_out_file_name(opt.out_dir, out_base_name, ".caption")
-
-                    if opt.format in ["txt","text","caption"]:
-                        print("writing caption to: ", out_file)
-                        async with aiofiles.open(out_file, "w") as out_file:
-                            await out_file.write(caption)
-
-                    if opt.format in ["filename", "mrwho", "joepenna"]:
-                        caption = caption.replace("/", "").replace("\\", "")  # must clean slashes using filename
-                        out_file = get_out_file_name(opt.out_dir, caption, file_ext)
-                        async with aiofiles.open(out_file, "wb") as out_file:
-                            await out_file.write(image_bin)
-                    elif opt.format == "json":
-                        raise NotImplementedError
-                    elif opt.format == "parquet":
-                        raise NotImplementedError
+                    batch.append((img_file_name, image_bin, load_image(image)))
+
+                if len(batch) >= opt.batch_size:
+                    i = await caption_batch(opt, blip_decoder, batch, i)
+                    batch = []
+
+    # last partial batch
+    if batch:
+        await caption_batch(opt, blip_decoder, batch, i)
+
+async def caption_batch(opt, blip_decoder, batch, i):
+    """
+    Captions a batch of (img_file_name, image_bin, image tensor) in one generate call and writes the results in
+    order, returns the next caption number
+    """
+    images = torch.stack([image for _, _, image in batch]).to(torch.device(opt.torch_device))
+
+    with torch.no_grad():
+        if opt.nucleus:
+            captions = blip_decoder.generate(images, sample=True, top_p=opt.q_factor)
+        else:
+            captions = blip_decoder.generate(images, sample=False, num_beams=16, min_length=opt.min_length, \
+                max_length=48, repetition_penalty=opt.q_factor)
+
+    for (img_file_name, image_bin, _), caption in zip(batch, captions):
+        file_ext = os.path.splitext(img_file_name)[1]
+
+        if opt.format in ["mrwho","joepenna"]:
+            prefix = f"{i:05}@"
+            i += 1
+            caption = prefix+caption
+        elif opt.format == "filename":
+            postfix = f"_{i}"
+            i += 1
+            caption = caption+postfix
+
+        if opt.format in ["txt","text","caption"]:
+            out_base_name = os.path.splitext(os.path.basename(img_file_name))[0]
+
+        if opt.format in ["txt","text"]:
+            out_file = get_out_file_name(opt.out_dir, out_base_name, ".txt")
+
+        if opt.format in ["caption"]:
+            out_file = get_out_file_name(opt.out_dir, out_base_name, ".caption")
+
+        if opt.format in ["txt","text","caption"]:
+            print("writing caption to: ", out_file)
+            async with aiofiles.open(out_file, "w") as out_file:
+                await out_file.write(caption)
+
+        if opt.format in ["filename", "mrwho", "joepenna"]:
+            caption = caption.replace("/", "").replace("\\", "")  # must clean slashes using filename
+            out_file = get_out_file_name(opt.out_dir, caption, file_ext)
+            async with aiofiles.open(out_file, "wb") as out_file:
+                await out_file.write(image_bin)
+        elif opt.format == "json":
+            raise NotImplementedError
+        elif opt.format == "parquet":
+            raise NotImplementedError
+
+    return i
 
 def isWindows():
     return sys.platform.startswith("win")
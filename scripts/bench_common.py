@@ -0,0 +1,32 @@
+"""
+Helpers shared by the offline benchmark scripts, bench_laion_download.py and bench_compress_img.py.
+"""
+import os
+import random
+import subprocess
+import sys
+
+from PIL import Image
+
+def synthetic_image(width: int, height: int, rng: random.Random, block: int = 16):
+    """ blocky noise, compresses about like a photo instead of like a flat color """
+    small_w, small_h = max(1, width // block), max(1, height // block)
+    small = Image.frombytes("RGB", (small_w, small_h), rng.randbytes(small_w * small_h * 3))
+    return small.resize((width, height), Image.BILINEAR)
+
+def run_measured(command: list):
+    """
+    Runs a command, returns its peak RSS in MB where os.wait4 is available (not on windows), which is the largest
+    single process of the command and any children it waited for
+    """
+    proc = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    if not hasattr(os, "wait4"):
+        returncode, peak_rss_mb = proc.wait(), None
+    else:
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = returncode = os.waitstatus_to_exitcode(status)
+        # ru_maxrss is KB on linux and bytes on macOS
+        peak_rss_mb = usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command)
+    return peak_rss_mb
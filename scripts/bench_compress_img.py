@@ -0,0 +1,351 @@
+"""
+Benchmarks for compress_img.py on a synthetic image corpus, runs entirely offline.
+
+    python scripts/bench_compress_img.py run --count 200 --workers 1,4,8 --json compress_img.json
+    python scripts/bench_compress_img.py engines --count 200 --workers 1,2,4,8
+    python scripts/bench_compress_img.py fast --count 40 --mp 6,12,24 --formats jpg
+    python scripts/bench_compress_img.py encoders --count 40 --target_kb 150
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from multiprocessing import cpu_count
+from queue import Queue
+
+import numpy as np
+from colorama import Fore, Style
+from PIL import Image
+
+import compress_img
+from bench_common import run_measured, synthetic_image
+
+FORMATS = {".jpg": "JPEG", ".png": "PNG", ".webp": "WEBP"}
+ORIENTATIONS = [3, 6, 8] # EXIF rotations by 180, 270 and 90 degrees
+STAGES = ["open_img", "transpose", "shrink", "slow_save"]
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def get_parser(**parser_kwargs):
+    parser = argparse.ArgumentParser(**parser_kwargs)
+    parser.add_argument("--seed", type=int, default=555, help="random seed for synthetic data")
+    subparsers = parser.add_subparsers(dest="bench", required=True)
+
+    run = subparsers.add_parser("run", help="run compress_img.py, report throughput, peak RSS and time per stage")
+    add_corpus_args(run)
+    run.add_argument("--workers", type=str, default=f"1,{cpu_count()}", help="csv of --workers values to run, default 1,cpu count")
+    run.add_argument("--fast", action="store_true", default=False, help="pass --fast to compress_img")
+    run.add_argument("--preset", type=str, default="webp", choices=list(compress_img.ENCODER_PRESETS), help="--preset passed to compress_img, default webp")
+    run.add_argument("--target_kb", type=float, default=0, help="--target_kb passed to compress_img, default 0")
+    run.add_argument("--json", type=str, default=None, help="also write the report to this json file")
+
+    engines = subparsers.add_parser("engines", help="process pool engine vs the old threads of event loops")
+    add_corpus_args(engines)
+    engines.add_argument("--workers", type=str, default=f"1,{cpu_count()}", help="csv of --workers values to run, default 1,cpu count")
+    engines.add_argument("--chunksize", type=int, default=8, help="--chunksize for the process pool engine, default 8")
+
+    fast = subparsers.add_parser("fast", help="--fast vs the full resolution decode and resize, speed and quality")
+    add_corpus_args(fast)
+    fast.add_argument("--min_psnr", type=float, default=30, help="fail if any --fast output is worse than this many dB, default 30")
+
+    encoders = subparsers.add_parser("encoders", help="size and speed of each --preset, and --target_kb attempts")
+    add_corpus_args(encoders)
+    encoders.add_argument("--presets", type=str, default=",".join(compress_img.ENCODER_PRESETS), help="csv of --preset values to run, default all")
+    encoders.add_argument("--target_kb", type=float, default=150, help="--target_kb to run with the webp preset, default 150")
+
+    return parser
+
+def add_corpus_args(parser):
+    parser.add_argument("--count", type=int, default=200, help="images in the synthetic corpus, default 200")
+    parser.add_argument("--mp", type=str, default="0.5,2,6,12", help="csv of image sizes in megapixels, default 0.5,2,6,12")
+    parser.add_argument("--formats", type=str, default="jpg,png,webp", help="csv of image formats, default jpg,png,webp")
+    parser.add_argument("--max_mp", type=float, default=1.5, help="--max_mp passed to compress_img, default 1.5")
+    parser.add_argument("--quality", type=int, default=95, help="--quality passed to compress_img, default 95")
+    parser.add_argument("--exif_rate", type=float, default=0.5, help="share of images with an EXIF orientation to correct, default 0.5")
+    parser.add_argument("--dir", type=str, default=None, help="where to write the corpus, default is a temp dir")
+
+def write_corpus(img_dir: str, args):
+    """ mixed formats and sizes, 3:2 landscape and portrait, some rotated by EXIF orientation """
+    rng = random.Random(args.seed)
+    sizes = [float(mp) for mp in args.mp.split(",")]
+    exts = [f".{ext}" for ext in args.formats.split(",")]
+    os.makedirs(img_dir, exist_ok=True)
+    total = 0
+    for i in range(args.count):
+        pixels = sizes[i % len(sizes)] * 1024000
+        width, height = int((pixels * 1.5) ** 0.5), int((pixels / 1.5) ** 0.5)
+        if i % 2:
+            width, height = height, width
+        ext = exts[i % len(exts)]
+        path = os.path.join(img_dir, f"img_{i:05}{ext}")
+        img = synthetic_image(width, height, rng)
+        exif = Image.Exif()
+        if rng.random() < args.exif_rate:
+            exif[0x0112] = rng.choice(ORIENTATIONS)
+        img.save(path, FORMATS[ext], exif=exif.tobytes())
+        total += os.path.getsize(path)
+    return total
+
+def compress_args(img_dir: str, out_dir: str, args, **kwargs):
+    return argparse.Namespace(img_dir=img_dir, out_dir=out_dir, max_mp=args.max_mp * 1024000, quality=args.quality,
+        overwrite=True, noresize=False, delete=False, **{"fast": False, "manifest": None, "max_memory_mb": 4096,
+        "preset": "webp", "method": None, "target_kb": 0, **kwargs})
+
+async def legacy_process(image, args):
+    """ process() before the process pool engine, open and save in the default executor, the rest on the loop """
+    loop = asyncio.get_running_loop()
+    outfile = image.replace(args.img_dir, args.out_dir).replace(os.path.splitext(image)[1], ".webp")
+    img = await loop.run_in_executor(None, compress_img.open_img, image)
+    if img:
+        newimg = compress_img.transpose(img)
+        if not args.noresize and compress_img.oversize(newimg, args.max_mp):
+            newimg = compress_img.shrink(newimg, args)
+        if newimg != img:
+            await loop.run_in_executor(None, compress_img.slow_save, outfile, args, newimg)
+
+async def legacy_worker(queue, args):
+    while not queue.empty():
+        await legacy_process(queue.get(), args)
+
+def legacy_launch_workers(queue, args):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    tasks = [loop.create_task(legacy_worker(queue, args)) for _ in range(10)]
+    loop.run_until_complete(asyncio.wait(tasks))
+    loop.close()
+
+def legacy_compression(files, args):
+    """ cpu_count() threads each running an event loop of 10 coroutines, as compress_img 2.0 did """
+    queue = Queue()
+    for file in files:
+        queue.put(file)
+    with ThreadPoolExecutor() as executor:
+        for _ in as_completed([executor.submit(legacy_launch_workers, queue, args) for _ in range(cpu_count())]):
+            pass
+
+def timed_run(out_dir: str, fn):
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.makedirs(out_dir)
+    s = time.perf_counter()
+    fn()
+    return time.perf_counter() - s
+
+def psnr(a: str, b: str):
+    """ peak signal to noise ratio of two images in dB, higher is closer, inf if identical """
+    x = np.asarray(Image.open(a).convert("RGB"), dtype=np.float64)
+    y = np.asarray(Image.open(b).convert("RGB"), dtype=np.float64)
+    if x.shape != y.shape:
+        return float("-inf")
+    mse = np.mean((x - y) ** 2)
+    return float("inf") if mse == 0 else 10 * np.log10(255 ** 2 / mse)
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError: # windows
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def serial_run(files, args):
+    """ one image at a time in a fresh process, returns (seconds, peak RSS MB) """
+    s = time.perf_counter()
+    for file in files:
+        compress_img.process(file, args)
+    return time.perf_counter() - s, peak_rss_mb()
+
+def staged_run(files, args):
+    """ one image at a time, returns seconds spent in each stage, decoding happens in transpose (shrink with --fast) """
+    stages = {name: 0.0 for name in STAGES}
+    originals = {name: getattr(compress_img, name) for name in STAGES}
+    def timed(name):
+        def stage(*stage_args, **stage_kwargs):
+            s = time.perf_counter()
+            try:
+                return originals[name](*stage_args, **stage_kwargs)
+            finally:
+                stages[name] += time.perf_counter() - s
+        return stage
+    for name in STAGES:
+        setattr(compress_img, name, timed(name))
+    try:
+        s = time.perf_counter()
+        for file in files:
+            compress_img.process(file, args)
+        return time.perf_counter() - s, stages
+    finally:
+        for name, fn in originals.items():
+            setattr(compress_img, name, fn)
+
+def bench_run(args):
+    work_dir = tempfile.mkdtemp(prefix="bench_compress_", dir=args.dir)
+    try:
+        img_dir = os.path.join(work_dir, "input")
+        out_dir = os.path.join(work_dir, "output")
+        print(f"{Fore.CYAN}writing {args.count} synthetic images of {args.mp} MP to {img_dir}...{Style.RESET_ALL}")
+        corpus_bytes = write_corpus(img_dir, args)
+        files = sorted(os.path.join(img_dir, name) for name in os.listdir(img_dir))
+        settings = dict(max_mp=args.max_mp, quality=args.quality, fast=args.fast, preset=args.preset, target_kb=args.target_kb)
+
+        runs = []
+        for workers in [int(w) for w in args.workers.split(",")]:
+            command = [sys.executable, os.path.join(SCRIPT_DIR, "compress_img.py"), "--img_dir", img_dir, "--out_dir", out_dir,
+                "--overwrite", "--workers", str(workers), "--max_mp", str(args.max_mp), "--quality", str(args.quality),
+                "--preset", args.preset, "--target_kb", str(args.target_kb)] + (["--fast"] if args.fast else [])
+            print(f"{Fore.CYAN}running compress_img.py with {workers} workers...{Style.RESET_ALL}")
+            shutil.rmtree(out_dir, ignore_errors=True)
+            start = time.perf_counter()
+            peak_rss_mb = run_measured(command)
+            elapsed = time.perf_counter() - start
+            runs.append(dict(workers=workers, elapsed_s=round(elapsed, 3), images_per_s=round(len(files) / elapsed, 2),
+                mb_per_s=round(corpus_bytes / 1024 / 1024 / elapsed, 2), peak_rss_mb=round(peak_rss_mb, 1) if peak_rss_mb else None))
+
+        # stage times in a fresh process so patching compress_img cannot leak into another run
+        print(f"{Fore.CYAN}timing stages one image at a time...{Style.RESET_ALL}")
+        shutil.rmtree(out_dir, ignore_errors=True)
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            elapsed, stages = executor.submit(staged_run, files, compress_args(img_dir, out_dir, args, fast=args.fast,
+                preset=args.preset, target_kb=args.target_kb)).result()
+        print()
+
+        report = dict(
+            version=compress_img.VERSION,
+            cpus=cpu_count(),
+            corpus=dict(images=len(files), mb=round(corpus_bytes / 1024 / 1024, 2), mp=args.mp, formats=args.formats,
+                exif_rate=args.exif_rate, seed=args.seed),
+            settings=settings,
+            runs=runs,
+            stages={name: dict(ms_per_image=round(seconds / len(files) * 1000, 2), share=round(seconds / elapsed, 3))
+                for name, seconds in stages.items()},
+        )
+
+        print(f" corpus:  {len(files)} images, {report['corpus']['mb']} MB, {report['cpus']} cpus")
+        for run in runs:
+            print(f" {run['workers']:3} workers  {run['images_per_s']:7.1f} images/s  {run['mb_per_s']:6.1f} MB/s  peak RSS {run['peak_rss_mb']} MB")
+        for name, stage in report["stages"].items():
+            print(f" {name:10} {stage['ms_per_image']:7.1f} ms/image  {stage['share'] * 100:4.0f}%")
+
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+        return report
+    finally:
+        shutil.rmtree(work_dir)
+
+def bench_fast(args):
+    work_dir = tempfile.mkdtemp(prefix="bench_compress_", dir=args.dir)
+    try:
+        img_dir = os.path.join(work_dir, "input")
+        print(f"{Fore.CYAN}writing {args.count} synthetic images of {args.mp} MP to {img_dir}...{Style.RESET_ALL}")
+        write_corpus(img_dir, args)
+        files = sorted(os.path.join(img_dir, name) for name in os.listdir(img_dir))
+
+        results = {}
+        for fast in [False, True]:
+            out_dir = os.path.join(work_dir, "fast" if fast else "full")
+            os.makedirs(out_dir)
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                results[fast] = executor.submit(serial_run, files, compress_args(img_dir, out_dir, args, fast=fast)).result()
+        print()
+
+        scores = {}
+        for file in files:
+            name = os.path.splitext(os.path.basename(file))[0] + ".webp"
+            scores[file] = psnr(os.path.join(work_dir, "full", name), os.path.join(work_dir, "fast", name))
+        for ext in sorted(set(os.path.splitext(file)[1] for file in files)):
+            ext_scores = [score for file, score in scores.items() if file.endswith(ext)]
+            identical = sum(score == float("inf") for score in ext_scores)
+            print(f" {ext:5} PSNR fast vs full:   min {min(ext_scores):0.1f} dB, median {np.median(ext_scores):0.1f} dB, {identical}/{len(ext_scores)} identical")
+
+        (full_time, full_rss), (fast_time, fast_rss) = results[False], results[True]
+        print(f" full:   {full_time / len(files) * 1000:7.1f} ms/image, peak RSS {full_rss:0.0f} MB")
+        print(f" fast:   {fast_time / len(files) * 1000:7.1f} ms/image, peak RSS {fast_rss:0.0f} MB")
+        print(f"{Fore.LIGHTGREEN_EX} speedup: {full_time / fast_time:0.1f}x{Style.RESET_ALL}")
+        assert min(scores.values()) >= args.min_psnr, f"--fast output below {args.min_psnr} dB PSNR"
+    finally:
+        shutil.rmtree(work_dir)
+
+def encoder_run(files, args):
+    """ serial run counting encode attempts, returns (seconds, attempts) """
+    attempts = 0
+    encode = compress_img.encode
+    def counted(*encode_args):
+        nonlocal attempts
+        attempts += 1
+        return encode(*encode_args)
+    compress_img.encode = counted
+    try:
+        s = time.perf_counter()
+        for file in files:
+            compress_img.process(file, args)
+        return time.perf_counter() - s, attempts
+    finally:
+        compress_img.encode = encode
+
+def bench_encoders(args):
+    work_dir = tempfile.mkdtemp(prefix="bench_compress_", dir=args.dir)
+    try:
+        img_dir = os.path.join(work_dir, "input")
+        print(f"{Fore.CYAN}writing {args.count} synthetic images of {args.mp} MP to {img_dir}...{Style.RESET_ALL}")
+        write_corpus(img_dir, args)
+        files = sorted(os.path.join(img_dir, name) for name in os.listdir(img_dir))
+
+        runs = [(preset, dict(preset=preset)) for preset in args.presets.split(",")]
+        runs.append((f"webp, {args.target_kb:g} KB target", dict(target_kb=args.target_kb)))
+        results = []
+        for name, kwargs in runs:
+            out_dir = os.path.join(work_dir, "output")
+            shutil.rmtree(out_dir, ignore_errors=True)
+            os.makedirs(out_dir)
+            elapsed, attempts = encoder_run(files, compress_args(img_dir, out_dir, args, **kwargs))
+            sizes = [os.path.getsize(os.path.join(out_dir, name)) for name in os.listdir(out_dir)]
+            over = sum(size > args.target_kb * 1024 for size in sizes) if "target_kb" in kwargs else None
+            results.append((name, elapsed, attempts, sizes, over))
+        print()
+
+        for name, elapsed, attempts, sizes, over in results:
+            line = f" {name:24} {elapsed / len(files) * 1000:7.1f} ms/image  {sum(sizes) / len(sizes) / 1024:7.1f} KB/image  {attempts / len(files):0.1f} encodes/image"
+            if over is not None:
+                line += f"  {over}/{len(sizes)} over target"
+            print(line)
+    finally:
+        shutil.rmtree(work_dir)
+
+def bench_engines(args):
+    work_dir = tempfile.mkdtemp(prefix="bench_compress_", dir=args.dir)
+    try:
+        img_dir = os.path.join(work_dir, "input")
+        out_dir = os.path.join(work_dir, "output")
+        print(f"{Fore.CYAN}writing {args.count} synthetic images of {args.mp} MP to {img_dir}...{Style.RESET_ALL}")
+        corpus_bytes = write_corpus(img_dir, args)
+        files = sorted(os.path.join(img_dir, name) for name in os.listdir(img_dir))
+
+        legacy_time = timed_run(out_dir, lambda: legacy_compression(files, compress_args(img_dir, out_dir, args)))
+        results = [("threads + event loops (2.0)", legacy_time)]
+        for workers in [int(w) for w in args.workers.split(",")]:
+            run_args = compress_args(img_dir, out_dir, args, workers=workers, chunksize=args.chunksize)
+            results.append((f"process pool, {workers} workers", timed_run(out_dir, lambda: compress_img.start_compression(files, run_args))))
+        print()
+
+        print(f" corpus:  {args.count} images, {corpus_bytes / 1024 / 1024:0.1f} MB, {cpu_count()} cpus")
+        for name, elapsed in results:
+            print(f" {name:32} {args.count / elapsed:7.1f} images/s  {corpus_bytes / 1024 / 1024 / elapsed:6.1f} MB/s  ({legacy_time / elapsed:0.2f}x)")
+    finally:
+        shutil.rmtree(work_dir)
+
+if __name__ == "__main__":
+    parser = get_parser()
+    args = parser.parse_args()
+
+    if args.bench == "run":
+        bench_run(args)
+    elif args.bench == "engines":
+        bench_engines(args)
+    elif args.bench == "fast":
+        bench_fast(args)
+    elif args.bench == "encoders":
+        bench_encoders(args)
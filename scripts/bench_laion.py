@@ -0,0 +1,260 @@
+"""
+Microbenchmarks for download_laion.py, runs entirely offline on synthetic data.
+
+    python scripts/bench_laion.py matcher --rows 1000000
+    python scripts/bench_laion.py names --files 200000
+    python scripts/bench_laion.py cleanup --rows 200000
+    python scripts/bench_laion.py index --rows 1000000
+"""
+import argparse
+import glob
+import os
+import random
+import re
+import shutil
+import tempfile
+import time
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from colorama import Fore, Style
+
+import download_laion
+import laion_index
+
+WORDS = ["photo", "man", "woman", "dog", "cat", "portrait", "painting", "blue", "red", "city", "beach", "art",
+    "old", "young", "smiling", "standing", "in", "the", "a", "of", "with", "on", "street", "sunset"]
+DOMAINS = ["example.com", "cdn.images.net", "pics.org", "alamy.com", "dreamstime.com", "123rf.com", "istockphoto.com",
+    "media.blog.io", "upload.wiki.org", "static.shop.com"]
+
+def get_parser(**parser_kwargs):
+    parser = argparse.ArgumentParser(**parser_kwargs)
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=555,
+        help="random seed for synthetic data",
+    )
+    subparsers = parser.add_subparsers(dest="bench", required=True)
+
+    matcher = subparsers.add_parser("matcher", help="TextMatcher vs the chained pandas str.contains filter")
+    matcher.add_argument("--rows", type=int, default=1000000, help="rows in the synthetic shard, default 1000000")
+    matcher.add_argument("--search_text", type=str, default="photo,man", help="csv of words with AND logic")
+    matcher.add_argument("--repeat", type=int, default=3, help="best of n runs, default 3")
+
+    names = subparsers.add_parser("names", help="OutputIndex vs a glob per row on a large output folder")
+    names.add_argument("--files", type=int, default=200000, help="files in the synthetic output folder, default 200000")
+    names.add_argument("--lookups", type=int, default=200, help="existence checks to time, default 200")
+    names.add_argument("--dir", type=str, default=None, help="where to create the folder, default is a temp dir")
+
+    cleanup = subparsers.add_parser("cleanup", help="cleanup_text and cleanup_text_column vs the chained str.replace version")
+    cleanup.add_argument("--rows", type=int, default=200000, help="synthetic captions, default 200000")
+
+    index = subparsers.add_parser("index", help="searches with the laion_index.py inverted index vs a full scan")
+    index.add_argument("--rows", type=int, default=1000000, help="rows in the synthetic parquet file, default 1000000")
+    index.add_argument("--searches", type=str, default="hokusai;photo,hokusai;by hokusai;photo;a man;smil.ng;zebra",
+        help="semicolon separated --search_text values to compare")
+    index.add_argument("--row_group_rows", type=int, default=20000, help="parquet row group size, the index reads whole row groups, default 20000")
+    index.add_argument("--dir", type=str, default=None, help="where to write the parquet file, default is a temp dir")
+
+    return parser
+
+def synthetic_table(rows: int, seed: int):
+    rng = random.Random(seed)
+    text = [" ".join(rng.choices(WORDS, k=rng.randint(3, 12))) for _ in range(rows)]
+    url = [f"https://{rng.choice(DOMAINS)}/images/{i}.jpg?w={rng.randint(256, 2048)}" for i in range(rows)]
+    return pa.table({"URL": url, "TEXT": text})
+
+def legacy_query(matches: pd.DataFrame, search_text: str, column: str):
+    """ the chained str.contains filter query_parquet used before TextMatcher """
+    for word in search_text.split(","):
+        matches = matches[matches[column].str.contains(word, case=False)]
+
+    for domain in download_laion.watermark_domains:
+        matches = matches[~matches["URL"].str.contains(domain, case=False)]
+
+    return matches
+
+def legacy_cleanup_text(file_name: str):
+    """ cleanup_text before the translate table, kept as the golden reference """
+
+    file_name = re.sub("<div.*<\/div>", "", file_name)
+    file_name = re.sub("<span.*<\/span>", "", file_name)
+    file_name = re.sub("<a.*<\/a>", "", file_name)
+    file_name = file_name.replace('<p>', '').replace("</p>", "")
+    file_name = file_name.replace('<strong>', '').replace("</strong>", "")
+    file_name = file_name.replace('<em>', '').replace("</em>", "")
+
+    file_name = re.sub(r'[^\x00-\x7F]+', '', file_name) # remove non-ascii
+
+    file_name = file_name.replace(' & ', ' and ').replace(' &', ' and').replace('& ', 'and ') \
+        .replace(" + ", " and ").replace(" +", " and").replace("+ ", "and ")
+
+    file_name = file_name.replace('\t', ' ').replace('\n', ' ').replace('\r', ' ')
+
+    file_name = file_name.replace('\"t"', ' ')
+
+    file_name = file_name.replace(" ♥ ","love").replace("♥ ","love ").replace(" ♥"," love") \
+        .replace("♥"," love ")
+
+    # remove bad chars
+    file_name = file_name.replace('\"', '').replace('?', '') \
+        .replace('<', '').replace('>', '').replace('/', '').replace('*', '') \
+        .replace('!', '').replace('#', '').replace('$', '').replace('%', '') \
+        .replace('^', '').replace('(', '').replace(')', '')
+    
+    # replace with space
+    file_name = file_name.replace(':',' ').replace('|',' ').replace('@', '') \
+        .replace("/", " ").replace("\\'", "\'").replace("\\", " ").replace('\\', ' ') \
+        .replace('_', ' ').replace("=", " ")
+    
+    # replace foreign chars
+    file_name = file_name.replace('é', 'e').replace('è', 'e').replace('ê', 'e') \
+        .replace('ë', 'e').replace('à', 'a').replace('â', 'a').replace('ä', 'a') \
+        .replace('ç', 'c').replace('ù', 'u').replace('û', 'u').replace('ü', 'u') \
+        .replace('ô', 'o').replace('ö', 'o').replace('ï', 'i').replace('î', 'i') \
+        .replace('í', 'i').replace('ì', 'i').replace('ñ', 'n').replace('ß', 'ss') \
+        .replace('á', 'a').replace('ã', 'a').replace('å', 'a').replace('æ', 'ae') \
+        .replace('œ', 'oe').replace('ø', 'o').replace('ð', 'd').replace('þ', 'th') \
+        .replace('ý', 'y').replace('ÿ', 'y').replace('ž', 'z').replace('ž', 'z') \
+        .replace('š', 's').replace('đ', 'd').replace('ď', 'd').replace('č', 'c') \
+        .replace('ć', 'c').replace('ř', 'r').replace('ŕ', 'r').replace('ľ', 'l') \
+        .replace('ĺ', 'l').replace('ť', 't').replace('ň', 'n').replace('ņ', 'n') \
+        .replace('ď', 'd').replace('Ď', 'D').replace('Ť', 'T').replace('Ň', 'N')
+
+    _MAX_LENGTH = 240
+    if (len(file_name) > _MAX_LENGTH):
+        file_name = file_name[:_MAX_LENGTH]
+    
+    return file_name
+
+CAPTION_TOKENS = ["<div class=x>", "</div>", "<span>", "</span>", "<a href=y>", "</a>", "<p>", "</p>", "<strong>", "</em>",
+    "&", "+", " ", " ", " ", "\t", "\n", '"t"', '"', "\\", "\\'", "'", "@", ":", "|", "_", "=", "?", "/", "*", "!", "#", "(",
+    ")", "é", "ñ", "♥", "ß", "日本"]
+
+def synthetic_captions(rows: int, seed: int):
+    """ mostly plain captions, with a share built from every character cleanup_text treats specially """
+    rng = random.Random(seed)
+    captions = []
+    for _ in range(rows):
+        if rng.random() < 0.7:
+            captions.append(" ".join(rng.choices(WORDS, k=rng.randint(3, 30))))
+        else:
+            captions.append("".join(rng.choices(WORDS + CAPTION_TOKENS, k=rng.randint(0, 60))))
+    return captions
+
+def best_of(repeat: int, fn):
+    best = None
+    result = None
+    for _ in range(repeat):
+        s = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - s
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def bench_matcher(args):
+    print(f"{Fore.CYAN}building synthetic shard of {args.rows} rows...{Style.RESET_ALL}")
+    table = synthetic_table(args.rows, args.seed)
+    df = table.to_pandas()
+    matcher = download_laion.TextMatcher(args.search_text.split(","), "TEXT", download_laion.watermark_domains)
+
+    legacy_time, legacy = best_of(args.repeat, lambda: legacy_query(df, args.search_text, "TEXT"))
+    new_time, new = best_of(args.repeat, lambda: matcher.filter(table))
+
+    assert legacy["URL"].tolist() == new["URL"].to_pylist(), "TextMatcher results differ from legacy filter"
+
+    print(f" matches:           {new.num_rows}")
+    print(f" chained pandas:    {legacy_time:0.3f}s ({args.rows/legacy_time:,.0f} rows/s)")
+    print(f" TextMatcher:       {new_time:0.3f}s ({args.rows/new_time:,.0f} rows/s)")
+    print(f"{Fore.LIGHTGREEN_EX} speedup:           {legacy_time/new_time:0.1f}x{Style.RESET_ALL}")
+
+def bench_names(args):
+    rng = random.Random(args.seed)
+    out_dir = tempfile.mkdtemp(prefix="bench_names_", dir=args.dir)
+    try:
+        print(f"{Fore.CYAN}creating {args.files} files in {out_dir}...{Style.RESET_ALL}")
+        for i in range(args.files):
+            open(os.path.join(out_dir, f"{' '.join(rng.choices(WORDS, k=6))} {i}.jpg"), "wb").close()
+
+        stems = [f"{' '.join(rng.choices(WORDS, k=6))} {rng.randint(0, args.files * 2)}" for _ in range(args.lookups)]
+
+        s = time.perf_counter()
+        legacy_hits = [any(glob.glob(os.path.join(out_dir, stem) + ".*")) for stem in stems]
+        glob_time = time.perf_counter() - s
+
+        s = time.perf_counter()
+        index = download_laion.OutputIndex(out_dir)
+        build_time = time.perf_counter() - s
+
+        s = time.perf_counter()
+        hits = [stem in index for stem in stems]
+        lookup_time = time.perf_counter() - s
+
+        assert hits == legacy_hits, "OutputIndex results differ from glob"
+
+        print(f" glob per row:      {glob_time/args.lookups*1000:0.3f} ms/lookup")
+        print(f" index build:       {build_time:0.3f}s (once per run)")
+        print(f" index lookup:      {lookup_time/args.lookups*1000000:0.3f} us/lookup")
+        print(f"{Fore.LIGHTGREEN_EX} break even after:  {build_time/(glob_time/args.lookups):0.1f} rows{Style.RESET_ALL}")
+    finally:
+        shutil.rmtree(out_dir)
+
+def bench_cleanup(args):
+    captions = synthetic_captions(args.rows, args.seed)
+    column = pa.array(captions)
+
+    legacy_time, legacy = best_of(1, lambda: [legacy_cleanup_text(caption) for caption in captions])
+    scalar_time, scalar = best_of(1, lambda: [download_laion.cleanup_text(caption) for caption in captions])
+    vector_time, vector = best_of(1, lambda: download_laion.cleanup_text_column(column).to_pylist())
+
+    assert scalar == legacy, "cleanup_text output differs from the golden reference"
+    assert vector == legacy, "cleanup_text_column output differs from the golden reference"
+
+    print(f" golden check:          {args.rows} captions identical")
+    print(f" chained str.replace:   {args.rows/legacy_time:,.0f} captions/s")
+    print(f" cleanup_text:          {args.rows/scalar_time:,.0f} captions/s")
+    print(f"{Fore.LIGHTGREEN_EX} cleanup_text_column:   {args.rows/vector_time:,.0f} captions/s{Style.RESET_ALL}")
+
+def bench_index(args):
+    rng = random.Random(args.seed)
+    work_dir = tempfile.mkdtemp(prefix="bench_index_", dir=args.dir)
+    try:
+        print(f"{Fore.CYAN}writing synthetic parquet file of {args.rows} rows to {work_dir}...{Style.RESET_ALL}")
+        table = synthetic_table(args.rows, args.seed)
+        # a rare word, like most artist or subject searches
+        text = [f"{caption} by hokusai" if i % 100000 == 0 else caption for i, caption in enumerate(table["TEXT"].to_pylist())]
+        table = table.set_column(1, "TEXT", pa.array(text))
+        table = table.append_column("WIDTH", pa.array([float(rng.choice([256, 512, 768, 1024])) for _ in range(args.rows)]))
+        table = table.append_column("HEIGHT", pa.array([float(rng.choice([256, 512, 768, 1024])) for _ in range(args.rows)]))
+        file = os.path.join(work_dir, "part-00000.parquet")
+        pq.write_table(table, file, row_group_size=args.row_group_rows)
+
+        s = time.perf_counter()
+        laion_index.build_index(file, "TEXT")
+        print(f" index build:       {time.perf_counter() - s:0.2f}s, {os.path.getsize(laion_index.index_path(file, 'TEXT')) / 1024 / 1024:0.1f} MB (once per file)")
+
+        parser = download_laion.get_parser()
+        for search_text in args.searches.split(";"):
+            scan_opt = parser.parse_args(["--search_text", search_text, "--ignore_index"])
+            opt = parser.parse_args(["--search_text", search_text])
+            scan_time, scanned = best_of(3, lambda: download_laion.query_parquet(download_laion.scan_parquet(file, scan_opt), scan_opt))
+            index_time, indexed = best_of(3, lambda: download_laion.query_parquet(download_laion.scan_parquet(file, opt), opt))
+            assert scanned["URL"].to_pylist() == indexed["URL"].to_pylist(), f"index results differ from full scan for {search_text}"
+            print(f" {search_text!r:24} {indexed.num_rows:>8} matches, full scan {scan_time:0.3f}s, index {index_time:0.3f}s ({scan_time/index_time:0.1f}x)")
+    finally:
+        shutil.rmtree(work_dir)
+
+if __name__ == "__main__":
+    parser = get_parser()
+    args = parser.parse_args()
+
+    if args.bench == "matcher":
+        bench_matcher(args)
+    elif args.bench == "names":
+        bench_names(args)
+    elif args.bench == "cleanup":
+        bench_cleanup(args)
+    elif args.bench == "index":
+        bench_index(args)
@@ -0,0 +1,225 @@
+"""
+Offline benchmark harness for the download_laion.py pipeline, no internet needed.
+
+    server  serves synthetic JPEG/PNG/WebP images with configurable size, latency, error rate and slow hosts
+    shards  writes synthetic LAION-like parquet files whose URLs point at the server
+    run     generates shards, starts the server, runs download_laion.py and reports images/s, p50/p99 latency and
+            peak RSS, any extra arguments after -- are passed to download_laion.py
+
+    python scripts/bench_laion_download.py run --rows 20000 --limit 5000
+    python scripts/bench_laion_download.py run --limit 5000 --slow_hosts 1 -- --workers 128 --per_host 16
+
+Head of line blocking on a slow host, half the rows point at a host that takes 4s per image, the other host should
+keep downloading at its full rate while the slow host's surplus rows are shed (host_backlog in the outcomes):
+
+    python scripts/bench_laion_download.py run --rows 5000 --shards 1 --limit 1500 --hosts 2 --slow_hosts 1 --slow_ms 4000 --error_rate 0
+
+Hosts are 127.0.0.1, 127.0.0.2, ... so per host limits apply as they would on the internet, this needs the whole
+127.0.0.0/8 loopback range which Linux and Windows have by default but macOS does not, use --hosts 1 there.
+"""
+import argparse
+import asyncio
+import glob
+import io
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from aiohttp import web
+from colorama import Fore, Style
+
+import laion_metrics
+from bench_common import run_measured, synthetic_image
+
+FORMATS = {"jpg": "JPEG", "png": "PNG", "webp": "WEBP"}
+WORDS = ["photo", "man", "woman", "dog", "cat", "portrait", "painting", "blue", "red", "city", "beach", "art"]
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def add_server_args(parser):
+    parser.add_argument("--port", type=int, default=8765, help="port on every host, default 8765")
+    parser.add_argument("--hosts", type=int, default=4, help="number of hosts, 127.0.0.1 to 127.0.0.N, default 4")
+    parser.add_argument("--image_px", type=int, default=768, help="width and height of served images, default 768")
+    parser.add_argument("--latency_ms", type=float, default=50, help="median response latency, default 50")
+    parser.add_argument("--latency_sigma", type=float, default=0.5, help="lognormal sigma of the latency, default 0.5")
+    parser.add_argument("--error_rate", type=float, default=0.05, help="share of requests answered 404 or 503, default 0.05")
+    parser.add_argument("--slow_hosts", type=int, default=0, help="number of hosts that add --slow_ms to every response")
+    parser.add_argument("--slow_ms", type=float, default=2000, help="extra latency of slow hosts, default 2000")
+
+def add_shard_args(parser):
+    parser.add_argument("--shards", type=int, default=2, help="parquet files to write, default 2")
+    parser.add_argument("--rows", type=int, default=20000, help="rows per parquet file, default 20000")
+    parser.add_argument("--match_rate", type=float, default=0.5, help="share of rows with 'photo' in TEXT, default 0.5")
+
+def get_parser(**parser_kwargs):
+    parser = argparse.ArgumentParser(**parser_kwargs)
+    parser.add_argument("--seed", type=int, default=555, help="random seed for synthetic data")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    server = subparsers.add_parser("server", help="serve synthetic images")
+    add_server_args(server)
+
+    shards = subparsers.add_parser("shards", help="write synthetic parquet files")
+    shards.add_argument("--out_dir", type=str, required=True, help="directory to write parquet files to")
+    shards.add_argument("--port", type=int, default=8765, help="server port the URLs point at, default 8765")
+    shards.add_argument("--hosts", type=int, default=4, help="number of hosts the URLs are spread over, default 4")
+    shards.add_argument("--image_px", type=int, default=768, help="WIDTH and HEIGHT written for every row, default 768")
+    add_shard_args(shards)
+
+    run = subparsers.add_parser("run", help="benchmark download_laion.py against the synthetic server")
+    add_server_args(run)
+    add_shard_args(run)
+    run.add_argument("--limit", type=int, default=5000, help="--limit passed to download_laion.py, default 5000")
+    run.add_argument("--json", type=str, default=None, help="also write the report to this json file")
+    run.add_argument("--keep", action="store_true", default=False, help="keep the temp folder with shards and output")
+
+    return parser
+
+def encoded_image(fmt: str, px: int, rng: random.Random):
+    buffer = io.BytesIO()
+    synthetic_image(px, px, rng, block=8).save(buffer, fmt)
+    return buffer.getvalue()
+
+def make_app(args):
+    rng = random.Random(args.seed)
+    pool = {ext: [encoded_image(fmt, args.image_px, rng) for _ in range(8)] for ext, fmt in FORMATS.items()}
+    slow = {f"127.0.0.{i + 1}" for i in range(args.slow_hosts)}
+    mu = math.log(args.latency_ms / 1000)
+
+    async def handle(request):
+        host = request.transport.get_extra_info("sockname")[0]
+        delay = rng.lognormvariate(mu, args.latency_sigma) + (args.slow_ms / 1000 if host in slow else 0)
+        await asyncio.sleep(delay)
+        if rng.random() < args.error_rate:
+            return web.Response(status=rng.choice([404, 503]))
+        images = pool[request.match_info["ext"]]
+        return web.Response(body=images[int(request.match_info["n"]) % len(images)], content_type="application/octet-stream")
+
+    app = web.Application()
+    app.router.add_get("/img/{n}.{ext}", handle)
+    return app
+
+async def serve(args):
+    runner = web.AppRunner(make_app(args), access_log=None)
+    await runner.setup()
+    for i in range(args.hosts):
+        await web.TCPSite(runner, f"127.0.0.{i + 1}", args.port).start()
+    print(f"serving {args.image_px}px images on 127.0.0.1-{args.hosts}:{args.port}", flush=True)
+    await asyncio.Event().wait()
+
+def write_shards(out_dir: str, args):
+    rng = random.Random(args.seed)
+    os.makedirs(out_dir, exist_ok=True)
+    exts = list(FORMATS)
+    for shard in range(args.shards):
+        url, text = [], []
+        for row in range(args.rows):
+            n = shard * args.rows + row
+            words = rng.choices(WORDS[1:], k=rng.randint(3, 10))
+            if rng.random() < args.match_rate:
+                words.insert(rng.randint(0, len(words)), "photo")
+            url.append(f"http://127.0.0.{n % args.hosts + 1}:{args.port}/img/{n}.{exts[n % len(exts)]}")
+            text.append(f"{' '.join(words)} {n}") # numbered so every caption is a distinct file name
+        table = pa.table({
+            "URL": url,
+            "TEXT": text,
+            "WIDTH": pa.array([float(args.image_px)] * args.rows),
+            "HEIGHT": pa.array([float(args.image_px)] * args.rows),
+            "punsafe": pa.array([rng.random() for _ in range(args.rows)]),
+            "aesthetic": pa.array([rng.uniform(5, 8) for _ in range(args.rows)]),
+        })
+        pq.write_table(table, os.path.join(out_dir, f"part-{shard:05}.parquet"), row_group_size=10000)
+
+def merged_latency(snapshot: dict):
+    merged = laion_metrics.HostLatency()
+    for host in snapshot.get("hosts", {}).values():
+        for count, bucket in zip(host["buckets"].values(), range(len(merged.buckets))):
+            merged.buckets[bucket] += count
+        merged.count += host["count"]
+        merged.total += (host["mean"] or 0) * host["count"]
+    return merged
+
+def wait_for_server(proc):
+    line = proc.stdout.readline()
+    if not line.startswith("serving"):
+        raise RuntimeError(f"benchmark server did not start: {line}")
+
+def run_benchmark(args, download_args: list):
+    work_dir = tempfile.mkdtemp(prefix="bench_laion_download_")
+    laion_dir = os.path.join(work_dir, "laion")
+    out_dir = os.path.join(work_dir, "output")
+    log_dir = os.path.join(work_dir, "logs")
+    print(f"{Fore.CYAN}writing {args.shards} x {args.rows} row parquet files to {laion_dir}...{Style.RESET_ALL}")
+    write_shards(laion_dir, args)
+
+    server_args = [f"--{name}={getattr(args, name)}" for name in
+        ["port", "hosts", "image_px", "latency_ms", "latency_sigma", "error_rate", "slow_hosts", "slow_ms"]]
+    server = subprocess.Popen([sys.executable, __file__, f"--seed={args.seed}", "server"] + server_args,
+        stdout=subprocess.PIPE, text=True)
+    try:
+        wait_for_server(server)
+        command = [sys.executable, os.path.join(SCRIPT_DIR, "download_laion.py"), "--laion_dir", laion_dir,
+            "--out_dir", out_dir, "--log_dir", log_dir, "--metrics_interval", "1", "--search_text", "photo",
+            "--limit", str(args.limit), "--min_hw", str(args.image_px - 1)] + download_args
+        print(f"{Fore.CYAN}running: {' '.join(command[1:])}{Style.RESET_ALL}")
+        start = time.perf_counter()
+        peak_rss_mb = run_measured(command)
+        elapsed = time.perf_counter() - start
+    finally:
+        server.terminate()
+        server.wait()
+
+    with open(glob.glob(os.path.join(log_dir, "metrics-*.jsonl"))[0], "r", encoding="utf-8") as f:
+        final = json.loads(f.readlines()[-1])
+    latency = merged_latency(final)
+
+    report = dict(
+        download_args=download_args,
+        images=final["images"],
+        elapsed_s=round(elapsed, 2),
+        images_per_s=round(final["images"] / elapsed, 2),
+        mb_per_s=round(final["bytes"] / 1024 / 1024 / elapsed, 2),
+        latency_p50_s=latency.percentile(0.5),
+        latency_p99_s=latency.percentile(0.99),
+        peak_rss_mb=round(peak_rss_mb, 1) if peak_rss_mb else None,
+        outcomes=final["outcomes"],
+    )
+
+    print(f" images:         {report['images']} in {report['elapsed_s']}s")
+    print(f" throughput:     {report['images_per_s']} images/s, {report['mb_per_s']} MB/s")
+    print(f" latency:        p50 <= {report['latency_p50_s']}s, p99 <= {report['latency_p99_s']}s")
+    print(f" peak RSS:       {report['peak_rss_mb']} MB")
+    print(f" outcomes:       {report['outcomes']}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if args.keep:
+        print(f"{Fore.LIGHTBLUE_EX}kept {work_dir}{Style.RESET_ALL}")
+    else:
+        shutil.rmtree(work_dir)
+    return report
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    download_args = []
+    if "--" in argv:
+        download_args = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+
+    parser = get_parser()
+    args = parser.parse_args(argv)
+
+    if args.command == "server":
+        asyncio.run(serve(args))
+    elif args.command == "shards":
+        write_shards(args.out_dir, args)
+    elif args.command == "run":
+        run_benchmark(args, download_args)
@@ -3,10 +3,16 @@
 """Compress images in a folder to a maximum megapixel size."""
 
 import argparse
-import asyncio
+import hashlib
+import io
+import json
+import math
 import os
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from glob import iglob
+import signal
+import sqlite3
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from multiprocessing import cpu_count
 from queue import Queue
 
@@ -14,11 +20,173 @@ from PIL import Image, ImageFile, ImageOps
 
 # Prevent errors from halting the script.
 ImageFile.LOAD_TRUNCATED_IMAGES = True
-Image.warnings.simplefilter("error", Image.DecompressionBombWarning)
 
-VERSION = "2.0"
+VERSION = "2.1"
 SHORT_DESCRIPTION = "Compress images in a directory."
 SUPPORTED_EXTENSIONS = [".jpg", ".jpeg", ".png", ".webp"]
+REDUCING_GAP = 2.0  # --fast, box-reduce to within 2x of the target before the final resize
+BYTES_PER_PIXEL = 8  # decoded RGBA image plus the transposed copy, the resized image is small next to them
+OUTPUT_SETTINGS = ["max_mp", "quality", "noresize", "fast", "preset", "method", "target_kb"]  # see settings_hash
+ENCODER_PRESETS = {
+    "webp": {"format": "WEBP"},  # the encoder's default effort, method 4
+    "webp_fast": {"format": "WEBP", "method": 0},
+    "webp_small": {"format": "WEBP", "method": 6},
+    "webp_lossless": {"format": "WEBP", "lossless": True},  # quality is the effort, not the size
+    "jpeg": {"format": "JPEG", "optimize": True, "progressive": True},
+}
+EXTENSIONS = {"WEBP": ".webp", "JPEG": ".jpg"}
+TARGET_SLACK = 0.9  # --target_kb, stop searching once an attempt fits and uses this much of the budget
+
+
+class Manifest:
+    """Finished images by source path, size and mtime, in a sqlite file."""
+
+    def __init__(self, path, settings, batch_size=256):
+        self.settings = settings
+        self.batch_size = batch_size
+        self.pending = []
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS images (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime_ns INTEGER,
+                settings TEXT,
+                outfile TEXT,
+                out_size INTEGER,
+                updated REAL
+            )""")
+        self.conn.commit()
+        self.entries = {
+            row[0]: row[1:]
+            for row in self.conn.execute(
+                "SELECT path, size, mtime_ns, settings, outfile, out_size FROM images"
+            )
+        }
+
+    def done(self, path, stat, outfile):
+        """Check if an image is unchanged since it was finished with the same settings to outfile and it is intact."""
+        entry = self.entries.get(path)
+        if entry is None or entry[:3] != (stat.st_size, stat.st_mtime_ns, self.settings):
+            return False
+        finished, out_size = entry[3:]
+        if finished is None:
+            return True
+        if os.path.abspath(finished) != os.path.abspath(outfile):
+            return False
+        try:
+            return os.stat(outfile).st_size == out_size
+        except OSError:
+            return False
+
+    def wrote(self, path, outfile):
+        """Check if outfile was written for an earlier version of the image, so it is this manifest's to replace."""
+        entry = self.entries.get(path)
+        return entry is not None and entry[3] is not None and os.path.abspath(entry[3]) == os.path.abspath(outfile)
+
+    def record(self, path, stat, outfile):
+        """Record a finished image, outfile is None if it needed no changes."""
+        outfile = os.path.abspath(outfile) if outfile else None
+        out_size = os.stat(outfile).st_size if outfile else None
+        entry = (stat.st_size, stat.st_mtime_ns, self.settings, outfile, out_size)
+        self.entries[path] = entry
+        self.pending.append((path,) + entry + (time.time(),))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.conn.executemany("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?)", self.pending)
+            self.conn.commit()
+            self.pending = []
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+def chunked(items, args, budget):
+    """Group (image, force, cost) into chunks, return (chunk, cost) with the cost of its largest image."""
+    chunk, cost = [], 0
+    for image, force, image_cost in items:
+        # a big image gets a chunk to itself so it does not hold up small ones in the same worker
+        if image_cost > budget / args.workers:
+            if chunk:
+                yield chunk, cost
+                chunk, cost = [], 0
+            yield [(image, force)], image_cost
+            continue
+        chunk.append((image, force))
+        cost = max(cost, image_cost)
+        if len(chunk) >= args.chunksize:
+            yield chunk, cost
+            chunk, cost = [], 0
+    if chunk:
+        yield chunk, cost
+
+
+def compress_bytes(data, args):
+    """Transpose, shrink and encode an image in memory."""
+    return encode_sized(transform(Image.open(io.BytesIO(data)), args), args)
+
+
+def decoded_bytes(path, args):
+    """Estimate the memory to process an image from its header."""
+    try:
+        with Image.open(path) as img:
+            width, height, fmt = img.width, img.height, img.format
+    except Exception:
+        return 0  # the worker reports the error
+    scale = 1
+    if args.fast and not args.noresize and fmt == "JPEG" and width * height > args.max_mp:
+        # the reduction draft() gets, it never decodes smaller than the target
+        scale = min(8, 2 ** int(math.log2(math.sqrt(width * height / args.max_mp))))
+    return (width // scale) * (height // scale) * BYTES_PER_PIXEL
+
+
+def draft(img, args):
+    """Let the JPEG decoder downscale an oversized image by up to 8x, return the size to shrink to."""
+    if img.format == "JPEG" and oversize(img, args.max_mp):
+        newhw = target_size(img.size, args.max_mp)
+        img.draft(img.mode, newhw)
+        return newhw
+    return None
+
+
+def encode(img, args, quality):
+    """Encode an image with the preset at a quality."""
+    options = dict(ENCODER_PRESETS[args.preset])
+    if args.method is not None and options["format"] == "WEBP":
+        options["method"] = args.method
+    buffer = io.BytesIO()
+    img.save(buffer, quality=quality, **options)
+    return buffer.getvalue()
+
+
+def encode_sized(img, args):
+    """Encode an image at the quality, or bisect down to the highest quality that fits in target_kb."""
+    preset = ENCODER_PRESETS[args.preset]
+    if preset["format"] == "JPEG" and img.mode not in ("RGB", "L", "CMYK"):
+        img = img.convert("RGB")
+    data = encode(img, args, args.quality)
+    target = args.target_kb * 1024
+    if not target or len(data) <= target or preset.get("lossless"):
+        return data
+    # every attempt encodes the same resized image, only the quality changes
+    best, low, high = None, 0, args.quality - 1
+    while low <= high:
+        quality = (low + high) // 2
+        attempt = encode(img, args, quality)
+        if len(attempt) <= target:
+            best, low = attempt, quality + 1
+            if len(attempt) >= target * TARGET_SLACK:
+                break
+        else:
+            data, high = attempt, quality - 1
+    # nothing fits, keep the smallest
+    return best or data
 
 
 def get_args(**parser_kwargs):
@@ -48,6 +216,27 @@ def get_args(**parser_kwargs):
         default=95,
         help="save quality (default: 95, range: 0-100, suggested: 90+)",
     )
+    parser.add_argument(
+        "--preset",
+        type=str,
+        default="webp",
+        choices=list(ENCODER_PRESETS),
+        help="encoder and effort (default: webp, webp_fast and webp_small trade size for speed and back, "
+        "jpeg is optimized progressive)",
+    )
+    parser.add_argument(
+        "--method",
+        type=int,
+        default=None,
+        choices=range(7),
+        help="WebP encoder effort, overrides the preset (range: 0-6, 0 is fastest, 6 is smallest)",
+    )
+    parser.add_argument(
+        "--target_kb",
+        type=float,
+        default=0,
+        help="lower the quality of images over this size until they fit (default: 0, off, quality is the upper bound)",
+    )
     parser.add_argument(
         "--overwrite",
         action="store_true",
@@ -66,17 +255,57 @@ def get_args(**parser_kwargs):
         default=False,
         help="delete original files after processing",
     )
+    parser.add_argument(
+        "--fast",
+        action="store_true",
+        default=False,
+        help="decode JPEGs at reduced size and box-reduce before resizing",
+    )
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        default=None,
+        help="sqlite file recording finished images, reruns skip images unchanged since (default: none)",
+    )
+    parser.add_argument(
+        "--max_memory_mb",
+        type=int,
+        default=4096,
+        help="memory for decoded images across all workers, larger images run alone (default: 4096)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=cpu_count(),
+        help=f"worker processes (default: {cpu_count()}, one per cpu)",
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=8,
+        help="images sent to a worker at a time (default: 8)",
+    )
     args = parser.parse_args()
     args.out_dir = args.out_dir or args.img_dir
     args.max_mp = args.max_mp * 1024000
     return args
 
 
-def images(img_dir):
-    """Return each image in the input directory."""
-    for file in iglob(f"{img_dir}/*.*"):
-        if file.lower().endswith(tuple(SUPPORTED_EXTENSIONS)):
-            yield file
+def images(img_dir, skip_dir=None):
+    """Return each image in the input directory and its subdirectories."""
+    subdirs = []
+    try:
+        with os.scandir(img_dir) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.name.lower().endswith(tuple(SUPPORTED_EXTENSIONS)):
+                    yield entry.path
+    except OSError as err:
+        inline(f"[!] Error Scanning: {img_dir} - {err}", True)
+    for subdir in subdirs:
+        if skip_dir is None or os.path.abspath(subdir) != skip_dir:
+            yield from images(subdir, skip_dir)
 
 
 def inline(msg, newline=False):
@@ -86,19 +315,16 @@ def inline(msg, newline=False):
     print(msg, end="\n" if newline else "", flush=True)
 
 
-def launch_workers(queue, args):
-    """Launch a pool of workers."""
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    tasks = [loop.create_task(worker(queue, args)) for _ in range(10)]
-    loop.run_until_complete(asyncio.wait(tasks))
+def init_worker():
+    """Leave Ctrl+C to the main process so workers finish their image."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    Image.MAX_IMAGE_PIXELS = None
 
 
-async def open_img(path):
+def open_img(path):
     """Open an image."""
-    loop = asyncio.get_running_loop()
     try:
-        return await loop.run_in_executor(None, Image.open, path)
+        return Image.open(path)
     except Exception as err:
         inline(f"[!] Error Opening: {path} - {err}", True)
         return None
@@ -109,71 +335,189 @@ def oversize(img, max_mp):
     return (img.width * img.height) > max_mp
 
 
-async def process(image, args):
-    """Process an image."""
-    outfile = image.replace(args.img_dir, args.out_dir).replace(
-        os.path.splitext(image)[1], ".webp"
-    )
-    if args.overwrite or not os.path.exists(outfile):
-        img = await open_img(image)
-        if img:
-            newimg = transpose(img)
-            if not args.noresize and oversize(newimg, args.max_mp):
-                newimg = shrink(newimg, args)
-            if newimg != img:
-                await save_img(newimg, outfile, args)
-                if args.delete and outfile != image:
-                    os.remove(image)
+def output_path(image, args):
+    """Return the output file, in the same subdirectory under out_dir."""
+    ext = EXTENSIONS[ENCODER_PRESETS[args.preset]["format"]]
+    relpath = os.path.relpath(os.path.splitext(image)[0] + ext, args.img_dir)
+    return os.path.join(args.out_dir, relpath)
+
+
+def process(image, args, force=False):
+    """Process an image, return the finished output or None."""
+    outfile = output_path(image, args)
+    if not (args.overwrite or force) and os.path.exists(outfile):
+        return outfile
+    img = open_img(image)
+    if not img:
+        return None
+    newimg = transform(img, args)
+    if newimg == img:
+        return ""
+    os.makedirs(os.path.dirname(outfile), exist_ok=True)
+    if not slow_save(outfile, args, newimg):
+        return None
+    if args.delete and outfile != image:
+        os.remove(image)
+    return outfile
+
+
+def process_chunk(chunk, args):
+    """Process a chunk of (image, force) in a worker."""
+    return [(image, process(image, args, force)) for image, force in chunk]
+
+
+def settings_hash(args):
+    """Hash the options that change the output."""
+    settings = json.dumps({name: getattr(args, name, None) for name in OUTPUT_SETTINGS}, sort_keys=True)
+    return hashlib.sha1(settings.encode()).hexdigest()[:16]
 
 
 def slow_save(path, args, img):
     """Save an image."""
     try:
-        img.save(path, "webp", quality=args.quality)
-        inline(f"[+] Compressed: {path}")
+        data = encode_sized(img, args)
+        # written whole or not at all, so a killed run never leaves an output that looks finished
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+        lossless = ENCODER_PRESETS[args.preset].get("lossless")
+        if args.target_kb and not lossless and len(data) > args.target_kb * 1024:
+            inline(f"[!] Over Target: {path} - {len(data) // 1024} KB at the lowest quality", True)
+        else:
+            inline(f"[+] Compressed: {path}")
+        return True
     except Exception as err:
         inline(f"[!] Error Saving: {path} - {err}", True)
+        return False
 
 
-async def save_img(img, path, args):
-    """Save an image."""
-    loop = asyncio.get_running_loop()
-    await loop.run_in_executor(None, slow_save, path, args, img)
+def scan_path(args):
+    """Scan the input directory for images in the background, return them as they are found."""
+    inline("[*] Scanning for images...", True)
+    # outputs in a folder inside the input folder are not inputs
+    out_dir = os.path.abspath(args.out_dir)
+    skip_dir = out_dir if out_dir != os.path.abspath(args.img_dir) else None
+    queue = Queue(maxsize=args.workers * args.chunksize * 4)
 
+    def scan():
+        for image in images(args.img_dir, skip_dir):
+            queue.put(image)
+        queue.put(None)
 
-def scan_path(queue, args):
-    """Scan the input directory for images."""
-    inline("[*] Scanning for images...", True)
-    for image in images(args.img_dir):
-        inline(f"[+] {image}")
-        queue.put(image)
+    threading.Thread(target=scan, daemon=True).start()
+    return iter(queue.get, None)
 
 
-def shrink(img, args):
+def shrink(img, args, newhw=None):
     """Shrink an image."""
-    hw = img.size
-    ratio = args.max_mp / (hw[0]*hw[1])
-    newhw = (int(hw[0]*ratio**0.5), int(hw[1]*ratio**0.5))
+    newhw = newhw or target_size(img.size, args.max_mp)
+    reducing_gap = REDUCING_GAP if args.fast else None
 
     try:
-        return img.resize(newhw, Image.BICUBIC)
+        return img.resize(newhw, Image.BICUBIC, reducing_gap=reducing_gap)
     except Exception as err:
         inline(f"[!] Error Shrinking: {img.filename} - {err}", True)
         return img
 
 
-def start_compression(queue, args):
+def start_compression(files, args):
     """Start the compression process."""
     inline("[*] Compressing images...", True)
-    inline("[-] (scanning...)")
-    with ThreadPoolExecutor() as executor:
-        workers = {
-            executor.submit(launch_workers, queue, args): None
-            for _ in range(cpu_count())
-        }
-        for _ in as_completed(workers):
-            pass
-    inline("[!] Done!", True)
+    manifest = Manifest(args.manifest, settings_hash(args)) if args.manifest else None
+    stats = {}
+    done = 0
+    unchanged = 0
+    unverified = 0
+
+    def todo():
+        nonlocal unchanged, unverified
+        for image in files:
+            force = False
+            if manifest:
+                path = os.path.abspath(image)
+                stat = os.stat(path)
+                outfile = output_path(image, args)
+                if not args.overwrite and manifest.done(path, stat, outfile):
+                    unchanged += 1
+                    continue
+                if not args.overwrite and os.path.exists(outfile) and not manifest.wrote(path, outfile):
+                    # an output the manifest did not write, ex. from a run without it, is only replaced with --overwrite
+                    manifest.record(path, stat, outfile)
+                    unverified += 1
+                    continue
+                stats[image] = stat
+                # the output was written for an older version of the image so it is stale, but a source that is its
+                # own output is never encoded again without --overwrite
+                force = os.path.abspath(outfile) != path
+            yield image, force, decoded_bytes(image, args)
+
+    def finish(results):
+        nonlocal done
+        for image, outfile in results:
+            done += 1
+            stat = stats.pop(image, None)
+            if manifest and outfile is not None:
+                manifest.record(os.path.abspath(image), stat, outfile or None)
+
+    budget = args.max_memory_mb * 1024 * 1024
+    chunks = chunked(todo(), args, budget)
+    executor = ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker)
+    try:
+        # a couple of chunks per worker in flight, so workers never wait, as long as the images being decoded fit
+        # in the memory budget, one chunk always runs so an image larger than the whole budget runs alone
+        pending = {}
+        in_flight = 0
+        next_chunk = None
+        while True:
+            while len(pending) < args.workers * 2:
+                next_chunk = next_chunk or next(chunks, None)
+                if next_chunk is None:
+                    break
+                chunk, cost = next_chunk
+                if pending and in_flight + cost > budget:
+                    break
+                pending[executor.submit(process_chunk, chunk, args)] = cost
+                in_flight += cost
+                next_chunk = None
+            if not pending:
+                break
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                in_flight -= pending.pop(future)
+                finish(future.result())
+    except KeyboardInterrupt:
+        inline(f"[!] Interrupted after {done} images, finishing images in progress...", True)
+        executor.shutdown(wait=True, cancel_futures=True)
+        for future in pending:
+            if not future.cancelled() and future.exception() is None:
+                finish(future.result())
+        inline("[!] Stopped", True)
+        return
+    finally:
+        if manifest:
+            manifest.close()
+    executor.shutdown(wait=True)
+    inline(f"[!] Done! {done} images, {unchanged} unchanged since the last run", True)
+    if unverified:
+        inline(f"[!] {unverified} existing outputs recorded without checking, use --overwrite to encode them again", True)
+
+
+def target_size(hw, max_mp):
+    """Return the size scaled down to max_mp pixels."""
+    ratio = max_mp / (hw[0]*hw[1])
+    return (int(hw[0]*ratio**0.5), int(hw[1]*ratio**0.5))
+
+
+def transform(img, args):
+    """Transpose and shrink an opened image."""
+    # the size from before a draft, so --fast gives the same output size
+    newhw = draft(img, args) if args.fast and not args.noresize else None
+    newimg = transpose(img)
+    if not args.noresize and oversize(newimg, args.max_mp):
+        if newhw and newimg.size != img.size:
+            newhw = newhw[::-1]
+        newimg = shrink(newimg, args, newhw)
+    return newimg
 
 
 def transpose(img):
@@ -185,20 +529,14 @@ def transpose(img):
         return img
 
 
-async def worker(queue, args):
-    """Handle images from the queue until they're gone."""
-    while not queue.empty():
-        image = queue.get()
-        await process(image, args)
-
-
 def main():
     """Run the program."""
-    queue = Queue()
     args = get_args(description=SHORT_DESCRIPTION)
+    # large images are not rejected, the memory budget runs them alone
+    Image.MAX_IMAGE_PIXELS = None
     inline(f"[>] Image Compression Utility v{VERSION}", True)
-    scan_path(queue, args)
-    start_compression(queue, args)
+    files = scan_path(args)
+    start_compression(files, args)
 
 
 if __name__ == "__main__":
@@ -1,7 +1,8 @@
 import sys
 import os
-import pandas as pd
 import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.compute as pc
 import argparse
 import glob
 #import requests_async as requests
@@ -13,16 +14,45 @@ import re
 from colorama import Fore, Style
 from PIL import Image
 import io
+import json
+import tarfile
+import collections
+import random
+import time
+from urllib.parse import urlsplit
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import laion_index
+import laion_journal
+import laion_metrics
 
 # can tweak these you feel like it, but shouldn't be needed
 unsafe_threshhold = 0.1 # higher values is more likely to be nsfw and will be skipped
 aesthetic_threshhold = 5 # higher is more aesthetic, note laion2B-aesthetic already >7?
 http_timeout = 10 
+dns_cache_ttl = 300 # seconds to cache DNS lookups, shared by all download workers
+http_chunk_size = 64 * 1024 
+header_probe_bytes = 1024 * 1024 # give up looking for an image header after this many bytes
+retry_statuses = (408, 429, 500, 502, 503, 504)
+throttle_statuses = (429, 503) # host is asking us to slow down
+retry_base_delay = 1 # seconds, doubled each attempt with full jitter
+retry_max_delay = 60
+slow_latency = 3 # seconds to response headers, slower than this counts as congestion for the host
+parked_per_host = 4 # jobs waiting per host, times its current limit, the feeder waits for a fast host and sheds for a slow one
+parked_per_worker = 4 # jobs parked across all hosts, times --workers, the feeder waits while this many are parked
+throttled_hosts = 100000 # idle hosts still cut below their starting limit that are remembered, oldest forgotten first
+watermark_domains = ["dreamstime.com", "alamy.com", "123rf.com", "colourbox.com", "envato.com", "stockfresh.com", "depositphotos.com", "istockphoto.com"]
 
 # dont touch
-downloaded_count = 0
-current_parquet_file_downloaded_count = 0
 logger_sp = None
+budget = None
+journal = None
+dedup = None
+shard_writer = None
+scheduler = None
+compressor = None
+compress_args = None
+metrics = laion_metrics.Metrics()
+output_index = None
 
 def get_base_prefix_compat():
     """Get base/real prefix, or sys.prefix if there is none."""
@@ -58,6 +88,62 @@ def get_parser(**parser_kwargs):
         default="./output",
         help="directory to download files to, defaults is ./output",
     ),
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        nargs="?",
+        const=True,
+        default="files",
+        help="'files' writes each image named after its caption, 'shards' streams images and .txt captions into tar shards, default is 'files'",
+    ),
+    parser.add_argument(
+        "--shard_mb",
+        type=int,
+        nargs="?",
+        const=True,
+        default=1000,
+        help="size in MB a tar shard is closed at with --output_format shards, default is 1000",
+    ),
+    parser.add_argument(
+        "--compress",
+        type=bool,
+        nargs="?",
+        const=True,
+        default=False,
+        help="fix EXIF rotation, shrink to --max_mp and save as WebP before writing, same as running compress_img.py afterwards",
+    ),
+    parser.add_argument(
+        "--max_mp",
+        type=float,
+        nargs="?",
+        const=True,
+        default=1.5,
+        help="max megapixels with --compress, default is 1.5",
+    ),
+    parser.add_argument(
+        "--quality",
+        type=int,
+        nargs="?",
+        const=True,
+        default=95,
+        help="WebP quality with --compress, default is 95",
+    ),
+    parser.add_argument(
+        "--compress_workers",
+        type=int,
+        nargs="?",
+        const=True,
+        default=0,
+        help="processes for --compress, default 0 is one per cpu",
+    ),
+    parser.add_argument(
+        "--ignore_index",
+        type=bool,
+        nargs="?",
+        const=True,
+        default=False,
+        help="always scan every row even if laion_index.py has indexed the parquet files",
+    ),
     parser.add_argument(
         "--log_dir",
         type=str,
@@ -66,6 +152,38 @@ def get_parser(**parser_kwargs):
         default=None,
         help="directory for logs, if ommitted will not log, logs may be large!",
     ),
+    parser.add_argument(
+        "--metrics_port",
+        type=int,
+        nargs="?",
+        const=True,
+        default=0,
+        help="serve live metrics as JSON on http://127.0.0.1:<port>/metrics, default 0 is off",
+    ),
+    parser.add_argument(
+        "--metrics_interval",
+        type=float,
+        nargs="?",
+        const=True,
+        default=10,
+        help="seconds between metrics snapshots written to --log_dir, default is 10",
+    ),
+    parser.add_argument(
+        "--journal",
+        type=str,
+        nargs="?",
+        const=True,
+        default=None,
+        help="sqlite file to record every download in, rerunning with the same journal skips finished rows",
+    ),
+    parser.add_argument(
+        "--dedup",
+        type=str,
+        nargs="?",
+        const=True,
+        default=None,
+        help="sqlite file of URLs and image hashes already downloaded, duplicates are never fetched or written twice",
+    ),
     parser.add_argument(
         "--column",
         type=str,
@@ -74,13 +192,53 @@ def get_parser(**parser_kwargs):
         default="TEXT",
         help="column to search for matches, defaults is 'TEXT', but you could use 'URL' if you wanted",
     ),
+    parser.add_argument(
+        "--blocklist",
+        type=str,
+        nargs="?",
+        const=True,
+        default=None,
+        help="text file of URL substrings to skip, one per line, replaces the built-in watermark domain list",
+    ),
     parser.add_argument(
         "--limit",
         type=int,
         nargs="?",
         const=True,
         default=100,
-        help="max number of matching images to download, warning: may be slightly imprecise due to concurrency and http errors, defaults is 100",
+        help="max number of matching images to download, defaults is 100",
+    ),
+    parser.add_argument(
+        "--workers",
+        type=int,
+        nargs="?",
+        const=True,
+        default=64,
+        help="number of concurrent download workers, default is 64",
+    ),
+    parser.add_argument(
+        "--per_host",
+        type=int,
+        nargs="?",
+        const=True,
+        default=8,
+        help="max concurrent connections to any single host, each host starts at 2 and adapts up to this, default is 8",
+    ),
+    parser.add_argument(
+        "--retries",
+        type=int,
+        nargs="?",
+        const=True,
+        default=3,
+        help="times to retry timeouts, connection errors and 429/5xx responses with backoff, default is 3",
+    ),
+    parser.add_argument(
+        "--scan_workers",
+        type=int,
+        nargs="?",
+        const=True,
+        default=0,
+        help="number of processes scanning parquet files in parallel with downloads, default 0 uses one background thread",
     ),
     parser.add_argument(
         "--min_hw",
@@ -90,6 +248,22 @@ def get_parser(**parser_kwargs):
         default=512,
         help="min height AND width of image to download, default is 512",
     ),
+    parser.add_argument(
+        "--max_bytes",
+        type=int,
+        nargs="?",
+        const=True,
+        default=0,
+        help="abort downloads larger than this many bytes, default 0 is no limit",
+    ),
+    parser.add_argument(
+        "--formats",
+        type=str,
+        nargs="?",
+        const=True,
+        default=None,
+        help="csv of image formats to keep, ex. \"jpeg,png,webp\", others are aborted once the header is read, default keeps all",
+    ),
     parser.add_argument(
         "--force",
         type=bool,
@@ -124,86 +298,262 @@ def get_parser(**parser_kwargs):
     
     return parser
 
-def cleanup_text(file_name: str):
-    # TODO: can be improved    
+# cleanup_text steps in the order they must run, the accented character and heart replacements of the old version
+# ran after non-ascii was already stripped, so they never did anything and are gone
+_HTML_BLOCKS = [re.compile(r"<div.*<\/div>"), re.compile(r"<span.*<\/span>"), re.compile(r"<a.*<\/a>")]
+_HTML_TAGS = ["<p>", "</p>", "<strong>", "</strong>", "<em>", "</em>"]
+_NON_ASCII = r"[^\x00-\x7F]+"
+_AMPERSANDS = [(" & ", " and "), (" &", " and"), ("& ", "and "), (" + ", " and "), (" +", " and"), ("+ ", "and ")]
+_QUOTED_T = ('"t"', " ")
+_DELETE_CHARS = "\"?<>/*!#$%^()@"
+_SPACE_CHARS = "\t\n\r:|_="
+_TRANSLATE = str.maketrans(_SPACE_CHARS, " " * len(_SPACE_CHARS), _DELETE_CHARS)
+_BACKSLASHES = [("\\'", "'"), ("\\", " ")] # a backslash may be left next to a quote only after deletions
+_MAX_LENGTH = 240
 
-    file_name = re.sub("<div.*<\/div>", "", file_name)
-    file_name = re.sub("<span.*<\/span>", "", file_name)
-    file_name = re.sub("<a.*<\/a>", "", file_name)
-    file_name = file_name.replace('<p>', '').replace("</p>", "")
-    file_name = file_name.replace('<strong>', '').replace("</strong>", "")
-    file_name = file_name.replace('<em>', '').replace("</em>", "")
+def cleanup_text(file_name: str):
+    """
+    Turns a LAION caption into a file name, each step is skipped when its characters are not present
+    """
+    if "<" in file_name:
+        for block in _HTML_BLOCKS:
+            file_name = block.sub("", file_name)
+        for tag in _HTML_TAGS:
+            file_name = file_name.replace(tag, "")
 
-    file_name = re.sub(r'[^\x00-\x7F]+', '', file_name) # remove non-ascii
+    if not file_name.isascii():
+        file_name = file_name.encode("ascii", "ignore").decode("ascii")
 
-    file_name = file_name.replace(' & ', ' and ').replace(' &', ' and').replace('& ', 'and ') \
-        .replace(" + ", " and ").replace(" +", " and").replace("+ ", "and ")
+    if "&" in file_name or "+" in file_name:
+        for old, new in _AMPERSANDS:
+            file_name = file_name.replace(old, new)
 
-    file_name = file_name.replace('\t', ' ').replace('\n', ' ').replace('\r', ' ')
+    file_name = file_name.replace(*_QUOTED_T).translate(_TRANSLATE)
 
-    file_name = file_name.replace('\"t"', ' ')
+    if "\\" in file_name:
+        for old, new in _BACKSLASHES:
+            file_name = file_name.replace(old, new)
 
-    file_name = file_name.replace(" ♥ ","love").replace("♥ ","love ").replace(" ♥"," love") \
-        .replace("♥"," love ")
+    return file_name[:_MAX_LENGTH]
 
-    # remove bad chars
-    file_name = file_name.replace('\"', '').replace('?', '') \
-        .replace('<', '').replace('>', '').replace('/', '').replace('*', '') \
-        .replace('!', '').replace('#', '').replace('$', '').replace('%', '') \
-        .replace('^', '').replace('(', '').replace(')', '')
-    
-    # replace with space
-    file_name = file_name.replace(':',' ').replace('|',' ').replace('@', '') \
-        .replace("/", " ").replace("\\'", "\'").replace("\\", " ").replace('\\', ' ') \
-        .replace('_', ' ').replace("=", " ")
-    
-    # replace foreign chars
-    file_name = file_name.replace('é', 'e').replace('è', 'e').replace('ê', 'e') \
-        .replace('ë', 'e').replace('à', 'a').replace('â', 'a').replace('ä', 'a') \
-        .replace('ç', 'c').replace('ù', 'u').replace('û', 'u').replace('ü', 'u') \
-        .replace('ô', 'o').replace('ö', 'o').replace('ï', 'i').replace('î', 'i') \
-        .replace('í', 'i').replace('ì', 'i').replace('ñ', 'n').replace('ß', 'ss') \
-        .replace('á', 'a').replace('ã', 'a').replace('å', 'a').replace('æ', 'ae') \
-        .replace('œ', 'oe').replace('ø', 'o').replace('ð', 'd').replace('þ', 'th') \
-        .replace('ý', 'y').replace('ÿ', 'y').replace('ž', 'z').replace('ž', 'z') \
-        .replace('š', 's').replace('đ', 'd').replace('ď', 'd').replace('č', 'c') \
-        .replace('ć', 'c').replace('ř', 'r').replace('ŕ', 'r').replace('ľ', 'l') \
-        .replace('ĺ', 'l').replace('ť', 't').replace('ň', 'n').replace('ņ', 'n') \
-        .replace('ď', 'd').replace('Ď', 'D').replace('Ť', 'T').replace('Ň', 'N')
-
-    _MAX_LENGTH = 240
-    if (len(file_name) > _MAX_LENGTH):
-        file_name = file_name[:_MAX_LENGTH]
+def cleanup_text_column(column):
+    """
+    Vectorized cleanup_text over a whole arrow string column, same output row for row
+    """
+    for block in _HTML_BLOCKS:
+        column = pc.replace_substring_regex(column, block.pattern, "")
+    for tag in _HTML_TAGS:
+        column = pc.replace_substring(column, tag, "")
+    column = pc.replace_substring_regex(column, _NON_ASCII, "")
+    for old, new in _AMPERSANDS + [_QUOTED_T]:
+        column = pc.replace_substring(column, old, new)
+    column = pc.replace_substring_regex(column, f"[{re.escape(_DELETE_CHARS)}]", "")
+    column = pc.replace_substring_regex(column, f"[{re.escape(_SPACE_CHARS)}]", " ")
+    for old, new in _BACKSLASHES:
+        column = pc.replace_substring(column, old, new)
+    # everything is ascii by now so code units are characters
+    return pc.utf8_slice_codeunits(column, 0, _MAX_LENGTH)
     
-    return file_name
-    
-async def call_http(image_url: str, session: aiohttp.ClientSession):
+class ImageRejected(Exception):
+    pass
+
+def inspect_header(data: bytearray, opt):
+    """
+    Checks the real format and size of a partially downloaded image, returns False if more bytes are needed
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+    except Exception:
+        if len(data) > header_probe_bytes:
+            raise ImageRejected(f"no image header in first {header_probe_bytes} bytes")
+        return False
+
+    if opt.formats and image.format.lower() not in opt.formats.lower().split(","):
+        raise ImageRejected(f"format {image.format}")
+    if image.width <= opt.min_hw or image.height <= opt.min_hw:
+        raise ImageRejected(f"actual size {image.width}x{image.height}")
+    return True
+
+async def read_image(res: aiohttp.ClientResponse, opt):
+    """
+    Streams the response body, aborting as soon as the header or size shows the image will not be kept
+    """
+    if opt.max_bytes and (res.content_length or 0) > opt.max_bytes:
+        raise ImageRejected(f"Content-Length {res.content_length} over max_bytes")
+
+    data = bytearray()
+    header_ok = False
+    hasher = laion_journal.content_hasher() if dedup else None
+    async for chunk in res.content.iter_chunked(http_chunk_size):
+        data += chunk
+        if hasher:
+            hasher.update(chunk)
+        if opt.max_bytes and len(data) > opt.max_bytes:
+            raise ImageRejected("over max_bytes")
+        if not header_ok:
+            header_ok = inspect_header(data, opt)
+
+    # bodies shorter than the header are left to get_outpath_filename to report as corrupt
+    return bytes(data), laion_journal.content_hash(hasher) if hasher else None
+
+class RetryableError(Exception):
+    def __init__(self, reason: str, retry_after: float = None):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+def retry_after_seconds(res: aiohttp.ClientResponse):
+    try:
+        return float(res.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None # missing, or an http-date which is rare enough to ignore
+
+async def call_http(image_url: str, session: aiohttp.ClientSession, opt, attempt: int = 0):
     #print(f"calling http and save to: {out_file_name}")
-    global downloaded_count
-    global http_timeout
-    global current_parquet_file_downloaded_count
+    host = urlsplit(image_url).hostname
+    can_retry = attempt < opt.retries
+    start = time.perf_counter()
     try:
-        res = await session.request(method="GET", url=image_url, timeout=http_timeout)
-        
-        if (res.status == 200):            
-            return await res.content.read()
-        else:
-            print(f"{Fore.YELLOW}Failed to download image, HTTP response code: {res.status} for {Fore.LIGHTWHITE_EX}{image_url}{Style.RESET_ALL}")
-            downloaded_count -= 1
+        async with session.get(image_url) as res:
+            latency = time.perf_counter() - start
+            if (res.status == 200):
+                scheduler.observe(host, latency, res.status)
+                metrics.latency(host, latency)
+                try:
+                    return await read_image(res, opt)
+                except ImageRejected as e:
+                    res.close() # drops the connection instead of reading the rest of the body
+                    print(f"{Fore.YELLOW}   aborted download, {str(e)}: {Fore.LIGHTWHITE_EX}{image_url}{Style.RESET_ALL}")
+                    metrics.outcome("aborted")
+                    if journal:
+                        journal.record(image_url, laion_journal.SKIPPED, http_code=res.status)
+                    return None, None
+            else:
+                scheduler.observe(host, latency, res.status)
+                metrics.latency(host, latency)
+                if can_retry and res.status in retry_statuses:
+                    raise RetryableError(f"http_{res.status}", retry_after_seconds(res))
+                print(f"{Fore.YELLOW}Failed to download image, HTTP response code: {res.status} for {Fore.LIGHTWHITE_EX}{image_url}{Style.RESET_ALL}")
+                metrics.outcome(f"http_{res.status}")
+                if journal:
+                    journal.record(image_url, journal.failure_status(res.status), http_code=res.status)
+    except RetryableError:
+        raise
+    except (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError) as e:
+        scheduler.observe(host, time.perf_counter() - start)
+        if can_retry:
+            raise RetryableError(type(e).__name__)
+        print(f"{Fore.YELLOW} *** Error downloading image: {Fore.LIGHTWHITE_EX}{image_url}{Fore.YELLOW}, ex: {type(e).__name__} {str(e)}{Style.RESET_ALL}")
+        metrics.outcome(type(e).__name__)
+        if journal:
+            journal.record(image_url, laion_journal.RETRY)
     except Exception as e:
         print(f"{Fore.YELLOW} *** Error downloading image: {Fore.LIGHTWHITE_EX}{image_url}{Fore.YELLOW}, ex: {str(e)}{Style.RESET_ALL}")
-        downloaded_count -= 1
+        metrics.outcome("error")
+        if journal:
+            journal.record(image_url, laion_journal.RETRY)
         pass
-    return None
+    return None, None
+
+class ShardWriter:
+    """
+    Appends images and caption sidecars to size bounded tar shards (WebDataset layout) from a single writer task,
+    each shard gets a .jsonl index of its samples with the member offsets
+    """
+    def __init__(self, out_dir: str, shard_bytes: int, queue_size: int):
+        self.out_dir = out_dir
+        self.shard_bytes = shard_bytes
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.shard_idx = len(glob.glob(os.path.join(out_dir, "shard-*.tar"))) # never reopen shards from earlier runs
+        self.sample_idx = 0
+        self.file = None
+        self.tar = None
+        self.index = None
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def write(self, data: memoryview, ext: str, caption: str, url: str):
+        """
+        Queues a sample and waits until it is on disk, returns "shard.tar/member" or None if it could not be written
+        """
+        done = asyncio.get_running_loop().create_future()
+        await self.queue.put((data, ext, caption, url, done))
+        return await done
+
+    async def close(self):
+        await self.queue.put(None)
+        await self.task
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            sample = await self.queue.get()
+            if sample is None:
+                await loop.run_in_executor(None, self.close_shard)
+                return
+            data, ext, caption, url, done = sample
+            try:
+                done.set_result(await loop.run_in_executor(None, self.append, data, ext, caption, url))
+            except Exception as e:
+                print(f"{Fore.RED} *** Unable to write to shard: {Fore.LIGHTWHITE_EX}{str(e)}{Style.RESET_ALL}")
+                done.set_result(None)
+
+    def open_shard(self):
+        name = f"shard-{self.shard_idx:05}"
+        self.shard_idx += 1
+        self.file = open(os.path.join(self.out_dir, f"{name}.tar"), "xb")
+        self.tar = tarfile.open(fileobj=self.file, mode="w", format=tarfile.USTAR_FORMAT)
+        self.index = open(os.path.join(self.out_dir, f"{name}.jsonl"), "x", encoding="utf-8")
+        print(f"{Fore.LIGHTBLUE_EX}   writing shard: {name}.tar{Style.RESET_ALL}")
+
+    def close_shard(self):
+        if self.tar is not None:
+            self.tar.close()
+            self.file.close()
+            self.index.close()
+            self.tar = None
+
+    def add_member(self, name: str, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        offset = self.tar.offset + len(info.tobuf(self.tar.format, self.tar.encoding, self.tar.errors))
+        self.tar.addfile(info, io.BytesIO(data))
+        return offset
+
+    def append(self, data: memoryview, ext: str, caption: str, url: str):
+        if self.tar is None:
+            self.open_shard()
+
+        key = f"{self.sample_idx:09}"
+        self.sample_idx += 1
+        offset = self.add_member(f"{key}.{ext}", data)
+        self.add_member(f"{key}.txt", caption.encode("utf-8"))
+        entry = dict(key=key, image=f"{key}.{ext}", offset=offset, size=len(data), caption=caption, url=url)
+        self.index.write(json.dumps(entry) + "\n")
+
+        location = f"{os.path.basename(self.file.name)}/{key}.{ext}"
+        if self.file.tell() >= self.shard_bytes:
+            self.close_shard()
+        return location
+
+async def save_img(buffer: io.BytesIO, full_outpath: str, clean_text: str, image_url: str):
+    """
+    Writes the image and returns where it was saved, or None
+    """
+    if shard_writer:
+        ext = os.path.splitext(full_outpath)[1][1:]
+        return await shard_writer.write(buffer.getbuffer(), ext, clean_text, image_url)
 
-async def save_img(buffer: io.BytesIO, full_outpath: str):
     try:
         async with aiofiles.open(full_outpath, "wb") as f:
             await f.write(buffer.getbuffer())
+        return full_outpath
     except Exception as e:
         print(f"{Fore.RED} *** Unable to write to disk: {Fore.LIGHTWHITE_EX}{full_outpath}{Style.RESET_ALL}")
         print(f"{Fore.RED} ***   ex: {Fore.LIGHTWHITE_EX}{str(e)}{Style.RESET_ALL}")
         pass
+    return None
 
 def get_outpath_filename(data: any, full_outpath_noext: str, clean_text: str):
     ext = "jpg"
@@ -221,114 +571,653 @@ def get_outpath_filename(data: any, full_outpath_noext: str, clean_text: str):
     except Exception as e:
         print(f"{Fore.YELLOW} *** Possible corrupt image for text: {Fore.LIGHTWHITE_EX}{clean_text}{Style.RESET_ALL}")
         print(f"{Fore.YELLOW} ***   ex: {Fore.LIGHTWHITE_EX}{str(e)}{Style.RESET_ALL}")
-        pass
+        buffer = None
     return full_outpath, buffer
 
-async def download_image(image_url: str, clean_text: str, full_outpath_noext: IO, session: aiohttp.ClientSession):
-    http_content = await call_http(image_url=image_url, session=session)
+def compress_image_bytes(data: bytes, args):
+    """
+    Runs in the compress pool, compress_img is only imported there so its Pillow settings stay out of this process
+    """
+    import compress_img
+    return compress_img.compress_bytes(data, args)
+
+async def compress_image(buffer: io.BytesIO, clean_text: str):
+    """
+    Returns the recompressed image in a new buffer, or None
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        return io.BytesIO(await loop.run_in_executor(compressor, compress_image_bytes, buffer.getvalue(), compress_args))
+    except Exception as e:
+        print(f"{Fore.YELLOW} *** Unable to compress image for text: {Fore.LIGHTWHITE_EX}{clean_text}{Style.RESET_ALL}")
+        print(f"{Fore.YELLOW} ***   ex: {Fore.LIGHTWHITE_EX}{str(e)}{Style.RESET_ALL}")
+        return None
+
+class OutputIndex:
+    """
+    Stems (file names without extension) of everything in out_dir, scanned once so existence checks are set lookups
+    instead of a glob over the whole directory per row
+    """
+    def __init__(self, out_dir: str):
+        self.stems = set()
+        with os.scandir(out_dir) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    self.stems.add(os.path.splitext(entry.name)[0])
+
+    def __contains__(self, stem: str):
+        return stem in self.stems
+
+    def __len__(self):
+        return len(self.stems)
+
+    def add(self, stem: str):
+        self.stems.add(stem)
+
+    def discard(self, stem: str):
+        self.stems.discard(stem)
+
+async def download_image(image_url: str, clean_text: str, full_outpath_noext: IO, session: aiohttp.ClientSession, opt, attempt: int = 0):
+    """
+    Returns True if the image was saved
+    """
+    http_content, content_key = await call_http(image_url=image_url, session=session, opt=opt, attempt=attempt)
 
     buffer = None
+    duplicate = None
 
     if (http_content is not None):
         full_outpath, buffer = get_outpath_filename(data=http_content, full_outpath_noext=full_outpath_noext, clean_text=clean_text)
+        if full_outpath is not None and compressor:
+            full_outpath = f"{full_outpath_noext}.webp"
+        if full_outpath is None:
+            metrics.outcome("corrupt")
+            if journal:
+                journal.record(image_url, laion_journal.FAILED, http_code=200, nbytes=len(http_content))
+
+    if buffer is not None and dedup:
+        duplicate = dedup.claim(content_key, full_outpath)
+        if duplicate:
+            print(f"{Fore.YELLOW}   same image already saved as {Fore.LIGHTWHITE_EX}{duplicate}{Fore.YELLOW}, skipping{Style.RESET_ALL}")
+            metrics.outcome("duplicate")
+            dedup.record_url(image_url)
+            if journal:
+                journal.record(image_url, laion_journal.SKIPPED, http_code=200, path=duplicate, nbytes=len(http_content))
+            buffer = None
 
-    if buffer is not None: 
-        global downloaded_count
-        downloaded_count += 1
-        await save_img(buffer, full_outpath)
-
-async def download_set_dict(opt, matches_dict: dict):
-    async with aiohttp.ClientSession() as session:
-        global downloaded_count
-        current_parquet_file_downloaded_count = 0
-        tasks = []
-        for row in matches_dict:
-            if downloaded_count < opt.limit:
-                current_parquet_file_downloaded_count += 1
-                pre_text=row["TEXT"]
-                image_url=row["URL"]
-
-                clean_text = cleanup_text(pre_text)
-
-                full_outpath_noext = os.path.join(opt.out_dir, clean_text)
-
-                if (opt.verbose):
-                    print(f"{Fore.LIGHTGREEN_EX}***** Verbose log: ***** {Style.RESET_ALL}")
-                    print(f"{Fore.LIGHTGREEN_EX}   url: {image_url}{Style.RESET_ALL}")
-                    print(f"{Fore.LIGHTGREEN_EX}  text: {pre_text}{Style.RESET_ALL}")
-                    print(f"{Fore.LIGHTGREEN_EX} captn: {clean_text}{Style.RESET_ALL}")
-
-                if any(glob.glob(full_outpath_noext + ".*")):                    
-                    print(f"{Fore.YELLOW}   already exists: {Fore.LIGHTWHITE_EX}{full_outpath_noext}{Fore.YELLOW}, skipping{Style.RESET_ALL}")
-                    return
-
-                if not opt.test:
-                    tasks.append(
-                        download_image(image_url=image_url, clean_text=clean_text, full_outpath_noext=full_outpath_noext, session=session)              
-                    )
-                else:
-                    current_parquet_file_downloaded_count += 1
-                    downloaded_count += 1
-                if len(tasks) > 63:
-                    await asyncio.gather(*tasks)
-                    tasks = []
+    if buffer is not None and compressor:
+        buffer = await compress_image(buffer, clean_text)
+        if buffer is None:
+            metrics.outcome("compress_error")
+            if journal:
+                journal.record(image_url, laion_journal.FAILED, http_code=200, nbytes=len(http_content))
+            if dedup:
+                dedup.release(image_url, content_key)
+
+    if buffer is None:
+        # nothing written, let a later row with the same caption have the name
+        output_index.discard(clean_text)
+        if dedup and not duplicate:
+            dedup.release_url(image_url)
+        return False
+    else:
+        saved_path = await save_img(buffer, full_outpath, clean_text, image_url)
+        if saved_path:
+            metrics.saved(len(http_content))
+        else:
+            output_index.discard(clean_text)
+            metrics.outcome("write_error")
+        if dedup:
+            if saved_path:
+                dedup.record(image_url, content_key, saved_path)
             else:
-                print(f"{Fore.YELLOW} Limit reached: {opt.limit}, exiting...{Style.RESET_ALL}")
+                dedup.release(image_url, content_key)
+        if journal:
+            status = laion_journal.SUCCESS if saved_path else laion_journal.RETRY
+            journal.record(image_url, status, http_code=200, path=saved_path or full_outpath, nbytes=len(http_content))
+        return saved_path is not None
+
+def create_session(opt):
+    """
+    One session for the whole run, the connector pools connections across all workers, caps connections per host
+    so one slow host cannot take every slot, and caches DNS
+    """
+    connector = aiohttp.TCPConnector(limit=opt.workers, limit_per_host=opt.per_host, ttl_dns_cache=dns_cache_ttl)
+    return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=http_timeout))
+
+class DownloadBudget:
+    """
+    Exact --limit: a download reserves a slot before it is fetched and gives it back if it fails, so no more than
+    the remaining number of images are ever in flight.  Once the limit is met everything still waiting is dropped.
+    """
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.reserved = 0
+        self.done = 0
+        self.changed = asyncio.Condition()
+        self.on_exhausted = []
+
+    @property
+    def exhausted(self):
+        return self.done >= self.limit
+
+    async def reserve(self):
+        """
+        Waits for a free slot, returns False if the limit was met while waiting
+        """
+        async with self.changed:
+            await self.changed.wait_for(lambda: self.exhausted or self.done + self.reserved < self.limit)
+            if self.exhausted:
+                return False
+            self.reserved += 1
+            return True
+
+    async def release(self, saved: bool):
+        async with self.changed:
+            self.reserved -= 1
+            if saved:
+                self.done += 1
+            self.changed.notify_all()
+        if saved and self.exhausted:
+            print(f"{Fore.YELLOW} Limit reached: {self.limit}, stopping...{Style.RESET_ALL}")
+            for callback in self.on_exhausted:
+                callback()
+
+class HostState:
+    def __init__(self, limit: float):
+        self.limit = limit
+        self.in_flight = 0
+        self.queued = 0 # in the download queue, not parked yet
+        self.deferred = collections.deque()
+        self.latency = 0.0 # seconds to response headers of the last response, or to the timeout
+        self.freed = time.perf_counter() # last time a download from this host finished
+
+class HostScheduler:
+    """
+    Per host AIMD concurrency and a delayed retry queue.  Each host's limit grows by 1/limit per success, up to
+    --per_host, and halves on throttling, server errors, timeouts or slow responses, other 4xx leave it unchanged.
+    Jobs for a host at its limit are parked instead of holding a worker, and run by whichever worker next frees a
+    slot on that host, a worker never waits on a host.  Parking is capped per host and in total, at either cap the
+    feeder waits in submit instead, except when the jobs waiting on a host would take more than slow_latency to get
+    through, then further jobs for it are shed (retried on resume with --journal) so one slow host cannot hold up
+    the feed for every other host.
+    """
+    def __init__(self, opt, queue: asyncio.Queue):
+        self.queue = queue
+        self.max_limit = opt.per_host
+        self.initial_limit = min(2, opt.per_host)
+        self.max_deferred = opt.workers * parked_per_worker
+        self.verbose = opt.verbose
+        self.hosts = {}
+        self.throttled = collections.OrderedDict() # idle hosts below initial_limit, oldest first
+        self.deferred = 0
+        self.outstanding = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.unparked = asyncio.Event()
+        self.retry_tasks = set()
+
+    def host(self, host: str):
+        state = self.hosts.get(host)
+        if state is None:
+            state = self.hosts[host] = HostState(self.initial_limit)
+        elif self.throttled:
+            self.throttled.pop(host, None)
+        return state
+
+    def forget(self, host: str, state: HostState):
+        """
+        Drops an idle host, a new one starts at initial_limit anyway, unless it was throttled below that, those are
+        kept (up to throttled_hosts) so a host that is struggling is not hit at full speed again
+        """
+        if state.limit >= self.initial_limit:
+            del self.hosts[host]
+            return
+        self.throttled[host] = None
+        if len(self.throttled) > throttled_hosts:
+            oldest, _ = self.throttled.popitem(last=False)
+            del self.hosts[oldest]
+
+    def observe(self, host: str, latency: float, status: int = None):
+        """
+        status is the http status, None for a timeout or connection error
+        """
+        state = self.host(host)
+        state.latency = latency
+        if status is None or status in throttle_statuses or status >= 500 or latency >= slow_latency:
+            state.limit = max(1.0, state.limit / 2)
+        elif status == 200:
+            state.limit = min(self.max_limit, state.limit + 1 / state.limit)
+        # other responses, ex. the 404 of a dead link, say nothing about how much load the host can take
+
+    async def submit(self, job: dict):
+        host = urlsplit(job["image_url"]).hostname
+        # looked up again after every await, an idle host can be forgotten meanwhile
+        while self.deferred >= self.max_deferred or self.backed_up(self.host(host)):
+            state = self.host(host)
+            # shed once the jobs already waiting take more than slow_latency to get through, a host that has not
+            # answered yet is as slow as the time since it last finished a download
+            latency = max(state.latency, time.perf_counter() - state.freed)
+            if self.backed_up(state) and latency * parked_per_host >= slow_latency:
+                self.shed(job)
+                return
+            self.unparked.clear()
+            try:
+                await asyncio.wait_for(self.unparked.wait(), slow_latency)
+            except asyncio.TimeoutError:
+                pass
+        self.outstanding += 1
+        self.idle.clear()
+        await self.queue.put(job)
+        # counted once it is in, no worker can take it before this line runs
+        self.host(host).queued += 1
+
+    def backed_up(self, state: HostState):
+        return state.queued + len(state.deferred) >= state.limit * parked_per_host
+
+    def park(self, state: HostState, job: dict):
+        state.deferred.append(job)
+        self.deferred += 1
+
+    def unpark(self, state: HostState):
+        self.deferred -= 1
+        self.unparked.set()
+        return state.deferred.popleft()
+
+    def shed(self, job: dict):
+        """
+        Gives up on a job for a host whose backlog is too slow to wait for, recorded as retry for the next run
+        """
+        metrics.outcome("host_backlog")
+        if self.verbose:
+            print(f"{Fore.YELLOW}   host backed up, shedding: {Fore.LIGHTWHITE_EX}{job['image_url']}{Style.RESET_ALL}")
+        output_index.discard(job["clean_text"])
+        if dedup:
+            dedup.release_url(job["image_url"])
+        if journal:
+            journal.record(job["image_url"], laion_journal.RETRY)
+
+    def finish(self):
+        self.outstanding -= 1
+        if self.outstanding == 0:
+            self.idle.set()
+
+    async def drain(self):
+        """
+        Waits for every submitted job, including parked jobs and pending retries, to reach a final outcome
+        """
+        await self.idle.wait()
+
+    async def run(self, job: dict, download):
+        host = urlsplit(job["image_url"]).hostname
+        state = self.host(host)
+        state.queued -= 1
+        if budget.exhausted:
+            self.finish()
+            return
+
+        if state.in_flight >= state.limit:
+            self.park(state, job)
+            return
+
+        while job is not None:
+            # the slot is taken before any await so the host is never idle, and forgotten, under a running job
+            state.in_flight += 1
+            if not await budget.reserve():
+                state.in_flight -= 1
+                self.finish()
                 break
-        if not opt.test & len(tasks) > 0:
-            await asyncio.gather(*tasks)
-    print(f"{Fore.LIGHTBLUE_EX}       Downloaded chunk of {current_parquet_file_downloaded_count} images{Style.RESET_ALL}")
 
-def query_parquet(df: pd.DataFrame, opt):
-    # TODO: efficiency, expression tree?
-    matches = df
+            saved = False
+            try:
+                saved = await download(job)
+                self.finish()
+            except RetryableError as e:
+                self.retry(job, e)
+            except Exception:
+                self.finish()
+                raise
+            finally:
+                await budget.release(saved)
+                state.in_flight -= 1
+                state.freed = time.perf_counter()
+
+            job = None
+            if state.deferred and state.in_flight < state.limit:
+                job = self.unpark(state)
+
+        if state.in_flight == 0 and state.queued == 0 and not state.deferred:
+            self.forget(host, state)
+
+    def retry(self, job: dict, e: RetryableError):
+        attempt = job.get("attempt", 0) + 1
+        metrics.outcome(f"retry_{str(e)}")
+        delay = random.uniform(0, min(retry_max_delay, retry_base_delay * 2 ** attempt))
+        if e.retry_after:
+            delay = max(delay, min(e.retry_after, retry_max_delay))
+        if self.verbose:
+            print(f"{Fore.YELLOW}   retry {attempt} in {delay:0.1f}s after {str(e)}: {Fore.LIGHTWHITE_EX}{job['image_url']}{Style.RESET_ALL}")
+        task = asyncio.create_task(self.requeue(dict(job, attempt=attempt), delay))
+        self.retry_tasks.add(task)
+        task.add_done_callback(self.retry_tasks.discard)
+
+    async def requeue(self, job: dict, delay: float):
+        try:
+            await asyncio.sleep(delay)
+            # a full queue can block here too, a cancel on either await means the job is never run
+            await self.queue.put(job)
+            self.host(urlsplit(job["image_url"]).hostname).queued += 1
+        except asyncio.CancelledError:
+            self.finish()
+            raise
+
+    def stop(self):
+        """
+        Drops parked jobs and pending retries once the limit is met, queued jobs are dropped as workers reach them
+        """
+        for state in self.hosts.values():
+            while state.deferred:
+                self.unpark(state)
+                self.finish()
+        for task in list(self.retry_tasks):
+            task.cancel()
+
+async def download_worker(queue: asyncio.Queue, session: aiohttp.ClientSession, opt):
+    """
+    Long lived worker, downloads jobs from the queue until it receives None
+    """
+    async def download(job):
+        return await download_image(session=session, opt=opt, **job)
+
+    while True:
+        job = await queue.get()
+        try:
+            if job is None:
+                return
+            await scheduler.run(job, download)
+        except Exception as e:
+            print(f"{Fore.RED} *** Download worker error: {Fore.LIGHTWHITE_EX}{str(e)}{Style.RESET_ALL}")
+        finally:
+            queue.task_done()
+
+def iter_matches(matches: pa.Table, batch_size: int = 1024):
+    """
+    Yields (URL, TEXT, CLEAN, URL_KEY) tuples one record batch at a time, rows past the point the caller stops are
+    never converted to python objects, URL_KEY is None unless the scan added it for --dedup
+    """
+    columns = [name for name in ["URL", "TEXT", "CLEAN", "URL_KEY"] if name in matches.column_names]
+    for batch in matches.select(columns).to_batches(max_chunksize=batch_size):
+        values = [column.to_pylist() for column in batch.columns]
+        if "URL_KEY" not in columns:
+            values.append([None] * batch.num_rows)
+        yield from zip(*values)
+
+async def download_set_dict(opt, matches):
+    """
+    Feeds (URL, TEXT, CLEAN, URL_KEY) rows into the download queue, blocks while the queue is full so memory stays
+    bounded
+    """
+    current_parquet_file_downloaded_count = 0
+    for image_url, pre_text, clean_text, url_key in matches:
+        if not budget.exhausted:
+            full_outpath_noext = os.path.join(opt.out_dir, clean_text)
+
+            if (opt.verbose):
+                print(f"{Fore.LIGHTGREEN_EX}***** Verbose log: ***** {Style.RESET_ALL}")
+                print(f"{Fore.LIGHTGREEN_EX}   url: {image_url}{Style.RESET_ALL}")
+                print(f"{Fore.LIGHTGREEN_EX}  text: {pre_text}{Style.RESET_ALL}")
+                print(f"{Fore.LIGHTGREEN_EX} captn: {clean_text}{Style.RESET_ALL}")
+
+            # only files are named after their caption, samples in tar shards are numbered so captions can repeat
+            check_names = opt.output_format == "files"
+
+            if check_names and clean_text in output_index:
+                print(f"{Fore.YELLOW}   already exists: {Fore.LIGHTWHITE_EX}{full_outpath_noext}{Fore.YELLOW}, skipping{Style.RESET_ALL}")
+                metrics.outcome("exists")
+                if journal:
+                    journal.record(image_url, laion_journal.SKIPPED)
+                continue
+
+            # canonical URL already written or queued, claimed only for rows that are queued, so a row skipped above
+            # does not hide a later row with the same URL, and rows past the limit cost nothing
+            if dedup and not dedup.claim_url(url_key):
+                continue
+
+            # reserve the name now so duplicate captions already in flight are skipped too
+            if check_names:
+                output_index.add(clean_text)
+            current_parquet_file_downloaded_count += 1
+
+            if not opt.test:
+                await scheduler.submit(dict(image_url=image_url, clean_text=clean_text, full_outpath_noext=full_outpath_noext))
+            else:
+                budget.done += 1
+        else:
+            print(f"{Fore.YELLOW} Limit reached: {opt.limit}, exiting...{Style.RESET_ALL}")
+            break
+    print(f"{Fore.LIGHTBLUE_EX}       Queued chunk of {current_parquet_file_downloaded_count} images{Style.RESET_ALL}")
+    return current_parquet_file_downloaded_count
+
+FILTER_COLUMNS = ["HEIGHT", "WIDTH", "TEXT", "punsafe", "aesthetic"]
+
+def scan_filter(schema: pa.Schema, opt):
+    """
+    Builds the numeric filter expression for a parquet dataset, pushed down so row groups whose
+    statistics cannot match are never decoded
+    """
+    expr = (ds.field("HEIGHT") > opt.min_hw) & (ds.field("WIDTH") > opt.min_hw) & ds.field("TEXT").is_valid()
+
+    if "punsafe" in schema.names:
+        expr = expr & (ds.field("punsafe") > unsafe_threshhold)
+
+    if "aesthetic" in schema.names:
+        expr = expr & (ds.field("aesthetic") > aesthetic_threshhold)
+
+    return expr
+
+def scan_columns(schema: pa.Schema, opt):
+    """
+    Columns that actually need to be read, filter-only columns (WIDTH, HEIGHT, etc) are not materialized
+    """
+    columns = ["URL", "TEXT"]
+    if opt.column not in columns and opt.column in schema.names:
+        columns.append(opt.column)
+    return columns
 
-    matches = matches[(matches.HEIGHT > opt.min_hw) &  (matches.WIDTH > opt.min_hw)]
+def scan_parquet(file: str, opt):
+    """
+    Reads a parquet file with column projection and predicate pushdown, returns only rows passing the numeric filters,
+    if the file has a current laion_index.py index for the searched column only rows that can match are read
+    """
+    dataset = ds.dataset(file, format="parquet")
+    columns = scan_columns(dataset.schema, opt)
+    rows = None
+    if not opt.ignore_index and opt.search_text:
+        rows = laion_index.search(file, opt.column, opt.search_text.split(","))
+    if rows is None:
+        return dataset.to_table(columns=columns, filter=scan_filter(dataset.schema, opt))
+    filter_columns = [name for name in FILTER_COLUMNS if name in dataset.schema.names]
+    return laion_index.read_rows(file, rows, columns, scan_filter(dataset.schema, opt), filter_columns)
 
-    if 'punsafe' in matches.columns:
-        matches = matches[(matches.punsafe > unsafe_threshhold)]
+def load_blocklist(path: str):
+    """
+    Reads URL substrings to block from a text file, blank lines and # comments are ignored
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        lines = [line.strip() for line in f]
+    return [line for line in lines if line and not line.startswith("#")]
 
-    if ('aesthetic' in matches):
-        matches = matches[(matches.aesthetic > aesthetic_threshhold)]
+class TextMatcher:
+    """
+    Compiled search terms (AND) and URL blocklist, the whole blocklist is one combined regex so it is a single
+    vectorized pass over the URL column instead of one pass per domain
+    """
+    def __init__(self, search_terms: list, column: str, blocklist: list):
+        # terms keep the regex semantics of the old pandas str.contains filter, (?i) is cheaper than ignore_case=True
+        self.search_patterns = [f"(?i){term}" for term in search_terms if term]
+        self.column = column
+        self.blocklist_pattern = "(?i)" + "|".join(re.escape(domain) for domain in blocklist) if blocklist else None
 
-    if opt.search_text:
-        for word in opt.search_text.split(","):
-            matches = matches[matches[opt.column].str.contains(word, case=False)]
+    def filter(self, table: pa.Table):
+        # each AND term only scans rows that survived the previous one
+        for pattern in self.search_patterns:
+            table = table.filter(pc.match_substring_regex(table[self.column], pattern))
 
-    matches = matches[~matches["URL"].str.contains("dreamstime.com", case=False)] # watermarks
-    matches = matches[~matches["URL"].str.contains("alamy.com", case=False)] # watermarks
-    matches = matches[~matches["URL"].str.contains("123rf.com", case=False)] # watermarks
-    matches = matches[~matches["URL"].str.contains("colourbox.com", case=False)] # watermarks
-    matches = matches[~matches["URL"].str.contains("envato.com", case=False)] # watermarks
-    matches = matches[~matches["URL"].str.contains("stockfresh.com", case=False)] # watermarks
-    matches = matches[~matches["URL"].str.contains("depositphotos.com", case=False)] # watermarks
-    matches = matches[~matches["URL"].str.contains("istockphoto.com", case=False)] # watermarks
+        if self.blocklist_pattern and table.num_rows > 0:
+            blocked = pc.match_substring_regex(table["URL"], self.blocklist_pattern)
+            table = table.filter(pc.invert(pc.fill_null(blocked, False)))
 
-    return matches
+        return table
+
+def build_matcher(opt):
+    search_terms = opt.search_text.split(",") if opt.search_text else []
+    blocklist = load_blocklist(opt.blocklist) if opt.blocklist else watermark_domains
+    return TextMatcher(search_terms, opt.column, blocklist)
+
+def query_parquet(table: pa.Table, opt, matcher: TextMatcher = None):
+    """
+    Text filtering on rows already passed through scan_parquet
+    """
+    matcher = matcher or build_matcher(opt)
+    return matcher.filter(table)
 
 async def download_laion_matches(opt):
     print(f"{Fore.LIGHTBLUE_EX}  Searching for {opt.search_text} in column: {opt.column} in {opt.laion_dir}/*.parquet{Style.RESET_ALL}")
-    
-    for idx, file in enumerate(glob.iglob(os.path.join(opt.laion_dir, "*.parquet"))):
-        if idx < opt.parquet_skip: 
-            print(f"{Fore.YELLOW} Skipping file {idx+1}/{opt.parquet_skip}: {file}{Style.RESET_ALL}")
-            continue
 
-        global downloaded_count
-        if downloaded_count < opt.limit:
+    global budget
+    budget = DownloadBudget(opt.limit)
+
+    global output_index
+    output_index = OutputIndex(opt.out_dir)
+    print(f"{Fore.LIGHTBLUE_EX}  {len(output_index)} files already in {opt.out_dir}{Style.RESET_ALL}")
+
+    global journal
+    if opt.journal:
+        journal = laion_journal.DownloadJournal(opt.journal)
+        print(f"{Fore.LIGHTBLUE_EX}  journal: {opt.journal}, {len(journal.finished)} rows already finished{Style.RESET_ALL}")
+
+    global dedup
+    if opt.dedup:
+        dedup = laion_journal.DedupStore(opt.dedup)
+        print(f"{Fore.LIGHTBLUE_EX}  dedup: {opt.dedup}, {len(dedup.contents)} images already saved{Style.RESET_ALL}")
+
+    reporter = laion_metrics.MetricsReporter(metrics, log_dir=opt.log_dir, port=opt.metrics_port, interval=opt.metrics_interval)
+    await reporter.start()
+    if opt.metrics_port:
+        print(f"{Fore.LIGHTBLUE_EX}  metrics: http://127.0.0.1:{opt.metrics_port}/metrics{Style.RESET_ALL}")
+
+    try:
+        await download_shards(opt)
+    finally:
+        summary = await reporter.stop()
+        print(f"{Fore.LIGHTBLUE_EX}  {summary['avg_images_per_s']} images/s, {summary['bytes'] / 1024 / 1024:0.1f} MB, outcomes: {summary['outcomes']}{Style.RESET_ALL}")
+        if journal:
+            journal.close()
+        if dedup:
+            dedup.close()
+
+def scan_shard(file: str, opt):
+    """
+    Scans and filters one parquet file, runs in a scan worker so the event loop keeps downloading, captions are
+    cleaned here too as one vectorized pass
+    """
+    start = time.perf_counter()
+    matches = query_parquet(scan_parquet(file, opt), opt)
+    matches = matches.append_column("CLEAN", cleanup_text_column(matches["TEXT"]))
+    # URL hashes for the journal and dedup are computed here too so they never stall downloads on the event loop
+    if opt.journal:
+        matches = matches.append_column("URL_HASH", pa.array(laion_journal.url_hashes(matches["URL"]), type=pa.int64()))
+    if opt.dedup:
+        url_keys = laion_journal.canonical_url_hashes(matches["URL"].to_pylist())
+        matches = matches.append_column("URL_KEY", pa.array(url_keys, type=pa.int64()))
+    return matches, time.perf_counter() - start
+
+def create_scan_executor(opt):
+    if opt.scan_workers > 0:
+        return ProcessPoolExecutor(max_workers=opt.scan_workers)
+    return ThreadPoolExecutor(max_workers=1)
+
+async def scan_shards(opt, files: list, executor):
+    """
+    Yields (file, matches, scan seconds) in file order while up to scan_workers more files are scanned ahead
+    """
+    loop = asyncio.get_running_loop()
+    ahead = max(1, opt.scan_workers)
+    files = iter(files)
+    pending = collections.deque()
+
+    def submit_next():
+        file = next(files, None)
+        if file is not None:
             print(f"{Fore.CYAN}  reading file: {file}{Style.RESET_ALL}")
+            pending.append((file, loop.run_in_executor(executor, scan_shard, file, opt)))
 
-            df = pd.read_parquet(file, engine="auto")
-            matches = query_parquet(df, opt)
-            # print(f"{Fore.CYAN}       matches in current parquet file:{ Style.RESET_ALL}")
-            # print(matches)
-            
-            match_dict = matches.to_dict('records') # TODO: pandas problems later in script... needs revisiting
+    for _ in range(ahead):
+        submit_next()
 
-            await download_set_dict(opt, match_dict)
-        else:
-            print(f"{Fore.YELLOW}limit reached before reading next parquet file. idx: {idx}, filename: {file}{Style.RESET_ALL}")
-            break
+    while pending:
+        file, future = pending.popleft()
+        matches, scan_seconds = await future
+        submit_next()
+        yield file, matches, scan_seconds
+
+async def download_shards(opt):
+    files = sorted(glob.iglob(os.path.join(opt.laion_dir, "*.parquet")))
+    for idx, file in enumerate(files[:opt.parquet_skip]):
+        print(f"{Fore.YELLOW} Skipping file {idx+1}/{opt.parquet_skip}: {file}{Style.RESET_ALL}")
+    files = files[opt.parquet_skip:]
+
+    global shard_writer
+    if opt.output_format == "shards":
+        shard_writer = ShardWriter(opt.out_dir, opt.shard_mb * 1024 * 1024, queue_size=opt.workers)
+        shard_writer.start()
+
+    global compressor, compress_args
+    if opt.compress:
+        compressor = ProcessPoolExecutor(max_workers=opt.compress_workers or None)
+        compress_args = argparse.Namespace(max_mp=opt.max_mp * 1024000, quality=opt.quality, noresize=False, fast=True,
+            preset="webp", method=None, target_kb=0)
+
+    global scheduler
+    async with create_session(opt) as session:
+        queue = asyncio.Queue(maxsize=opt.workers * 2)
+        scheduler = HostScheduler(opt, queue)
+        budget.on_exhausted.append(scheduler.stop)
+        metrics.gauge("download_queue", queue.qsize)
+        metrics.gauge("parked", lambda: scheduler.deferred)
+        metrics.gauge("retrying", lambda: len(scheduler.retry_tasks))
+        metrics.gauge("in_flight", lambda: sum(state.in_flight for state in scheduler.hosts.values()))
+        metrics.gauge("hosts", lambda: len(scheduler.hosts))
+        if shard_writer:
+            metrics.gauge("shard_writer_queue", shard_writer.queue.qsize)
+        workers = [asyncio.create_task(download_worker(queue, session, opt)) for _ in range(opt.workers)]
+        executor = create_scan_executor(opt)
+
+        try:
+            async for file, matches, scan_seconds in scan_shards(opt, files, executor):
+                if budget.exhausted:
+                    print(f"{Fore.YELLOW}limit reached, not downloading from parquet file: {file} or any after it{Style.RESET_ALL}")
+                    break
+
+                if journal:
+                    # numpy releases the GIL for the search, so downloads keep running while a large journal is checked
+                    matches = await asyncio.get_running_loop().run_in_executor(None, journal.anti_join, matches)
+
+                feed_start = time.perf_counter()
+                queued = await download_set_dict(opt, iter_matches(matches))
+                metrics.shard(file, scan_seconds, time.perf_counter() - feed_start, matches.num_rows, queued)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        await scheduler.drain()
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+
+    if shard_writer:
+        await shard_writer.close()
+    if compressor:
+        compressor.shutdown()
 
 def isWindows():
     return sys.platform.startswith('win')
@@ -354,6 +1243,10 @@ if __name__ == '__main__':
         print(f"** Use --force to bypass safety to dump entire DB{Style.RESET_ALL}")
         sys.exit(2)
 
+    if opt.output_format not in ["files", "shards"]:
+        print(f"{Fore.YELLOW}** --output_format must be 'files' or 'shards'{Style.RESET_ALL}")
+        sys.exit(2)
+
     ensure_path_exists(opt.out_dir)
 
     if (opt.laion_dir[-1] != "/" or opt.laion_dir[-1] != "\\"):
@@ -373,5 +1266,5 @@ if __name__ == '__main__':
     elapsed = time.perf_counter() - s
     print(f"{Fore.CYAN} **** Job Complete ****")
     print(f" search_text: \"{opt.search_text}\", force: {opt.force}")
-    print(f" Total downloaded {downloaded_count} images")
+    print(f" Total downloaded {budget.done} images")
     print(f"{__file__} executed in {elapsed:0.2f} seconds.{Style.RESET_ALL}{Style.RESET_ALL}")
\ No newline at end of file
@@ -0,0 +1,194 @@
+"""
+Persistent inverted index over LAION parquet files, so repeat searches read only the rows that can match instead of
+scanning every caption again.
+
+Each parquet file gets a <name>.<column>.idx file next to it (parquet, but not named *.parquet so it is never mistaken
+for a LAION file) with one row per distinct lowercase word: the word and the sorted row numbers it appears in.  Search
+terms keep their substring semantics, a term's words are looked up as substrings of the indexed words, which gives a
+superset of the matching rows that download_laion.py then filters exactly as before.
+
+    python scripts/laion_index.py --laion_dir ./laion
+    python scripts/laion_index.py --laion_dir ./laion --columns TEXT,URL --workers 8
+"""
+import argparse
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from colorama import Fore, Style
+
+INDEX_VERSION = "1"
+TOKEN_SPLIT = r"[^\pL\pN_]+" # RE2, anything that is not a letter, number or underscore separates words
+TOKENS_PER_ROW_GROUP = 64 * 1024
+POSTINGS_PER_ROW_GROUP = 256 * 1024 # so reading a rare word's rows does not decode a common word's too
+REGEX_CHARS = set(".^$*+?{}[]\\|()")
+SELECTIVE_SHARE = 0.2 # words in more rows than this share are left to the exact filter, reading that many rows one by one is slower than a scan
+
+def get_parser(**parser_kwargs):
+    parser = argparse.ArgumentParser(**parser_kwargs)
+    parser.add_argument("--laion_dir", type=str, default="./laion", help="directory with laion parquet files, default is ./laion")
+    parser.add_argument("--columns", type=str, default="TEXT", help="csv of columns to index, default is TEXT, ex. \"TEXT,URL\"")
+    parser.add_argument("--workers", type=int, default=1, help="parquet files to index in parallel, default 1")
+    parser.add_argument("--overwrite", action="store_true", default=False, help="rebuild indexes that are already up to date")
+    return parser
+
+def index_path(file: str, column: str):
+    return f"{os.path.splitext(file)[0]}.{column}.idx"
+
+def source_stamp(file: str):
+    stat = os.stat(file)
+    return {b"version": INDEX_VERSION.encode(), b"size": str(stat.st_size).encode(), b"mtime_ns": str(stat.st_mtime_ns).encode()}
+
+def tokenize(column):
+    return pc.split_pattern_regex(pc.utf8_lower(column), TOKEN_SPLIT)
+
+def build_index(file: str, column: str):
+    """
+    Writes the index of one column of one parquet file, returns (words, rows)
+    """
+    text = pq.read_table(file, columns=[column])[column].combine_chunks()
+    tokens = tokenize(text)
+    flat = pc.list_flatten(tokens)
+    rows = pc.list_parent_indices(tokens).to_numpy()
+    not_empty = pc.not_equal(flat, "")
+    flat = flat.filter(not_empty)
+    rows = rows[not_empty.to_numpy(zero_copy_only=False)]
+
+    encoded = flat.dictionary_encode()
+    order = pc.array_sort_indices(encoded.dictionary).to_numpy()
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    token_ids = rank[encoded.indices.to_numpy()]
+
+    # one sort gives postings grouped by word in word order, with duplicate words in a row removed
+    keys = np.sort((token_ids.astype(np.int64) << 32) | rows.astype(np.int64))
+    keys = keys[np.concatenate([[True], keys[1:] != keys[:-1]])]
+    postings = (keys & 0xFFFFFFFF).astype(np.uint32)
+    offsets = np.zeros(len(order) + 1, dtype=np.int32)
+    counts = np.bincount(keys >> 32, minlength=len(order))
+    np.cumsum(counts, out=offsets[1:])
+
+    table = pa.table({
+        "token": encoded.dictionary.take(pa.array(order)),
+        "count": pa.array(counts.astype(np.uint32)),
+        "rows": pa.ListArray.from_arrays(pa.array(offsets), pa.array(postings)),
+    }).replace_schema_metadata(source_stamp(file))
+
+    path = index_path(file, column)
+    with pq.ParquetWriter(path + ".tmp", table.schema, compression="zstd", use_dictionary=["token"],
+            column_encoding={"rows.list.element": "DELTA_BINARY_PACKED"}) as writer:
+        start = 0
+        while start < len(order):
+            end = min(int(np.searchsorted(offsets, offsets[start] + POSTINGS_PER_ROW_GROUP, side="right")) - 1, len(order))
+            end = min(max(end, start + 1), start + TOKENS_PER_ROW_GROUP)
+            writer.write_table(table.slice(start, end - start), row_group_size=TOKENS_PER_ROW_GROUP)
+            start = end
+    os.replace(path + ".tmp", path)
+    return len(order), len(text)
+
+def is_current(file: str, column: str):
+    path = index_path(file, column)
+    if not os.path.exists(path):
+        return False
+    metadata = pq.read_schema(path).metadata or {}
+    return all(metadata.get(key) == value for key, value in source_stamp(file).items())
+
+def take_rows(parquet: pq.ParquetFile, rows: np.ndarray, columns: list):
+    """
+    Reads only the row groups holding rows (sorted row numbers), then just those rows
+    """
+    if len(rows) == 0:
+        return parquet.schema_arrow.empty_table().select(columns)
+    starts = np.cumsum([0] + [parquet.metadata.row_group(i).num_rows for i in range(parquet.num_row_groups)])
+    row_groups = np.searchsorted(starts, rows, side="right") - 1
+    groups = np.unique(row_groups)
+    table = parquet.read_row_groups(groups.tolist(), columns=columns)
+    # where each group read starts within the table just read
+    group_offsets = np.concatenate([[0], np.cumsum(starts[groups + 1] - starts[groups])[:-1]])
+    return table.take(pa.array(rows - starts[row_groups] + group_offsets[np.searchsorted(groups, row_groups)]))
+
+def literal_words(search_terms: list):
+    """
+    Words every matching row must contain as a substring of one of its own words, None if a term is a regex (or there
+    are no terms) and the index cannot narrow the search
+    """
+    terms = [term for term in search_terms if term]
+    if not terms or any(REGEX_CHARS.intersection(term) for term in terms):
+        return None
+    words = pc.list_flatten(tokenize(pa.array(terms))).to_pylist()
+    return sorted(set(word for word in words if word)) or None
+
+def search(file: str, column: str, search_terms: list):
+    """
+    Sorted numbers of the rows of file that can match every search term, or None if there is no usable index or the
+    search is too common for the index to beat a full scan
+    """
+    words = literal_words(search_terms)
+    if words is None or not is_current(file, column):
+        return None
+
+    max_rows = SELECTIVE_SHARE * pq.ParquetFile(file).metadata.num_rows
+    index = pq.ParquetFile(index_path(file, column))
+    vocabulary = index.read(columns=["token", "count"])
+    counts = vocabulary["count"].to_numpy()
+    # rarest words first, the row count of a word is at most the sum over the indexed words containing it
+    candidates = []
+    for word in words:
+        hits = np.flatnonzero(pc.match_substring(vocabulary["token"], word).to_numpy(zero_copy_only=False))
+        candidates.append((int(counts[hits].sum()), hits))
+    candidates = sorted((candidate for candidate in candidates if candidate[0] <= max_rows), key=lambda candidate: candidate[0])
+    if not candidates:
+        return None
+
+    rows = None
+    for _, hits in candidates:
+        postings = take_rows(index, hits, ["rows"])["rows"]
+        word_rows = np.unique(pc.list_flatten(postings).to_numpy()).astype(np.int64)
+        rows = word_rows if rows is None else np.intersect1d(rows, word_rows, assume_unique=True)
+        if len(rows) == 0:
+            break
+    return rows
+
+def read_rows(file: str, rows: np.ndarray, columns: list, filter=None, filter_columns: list = None):
+    """
+    Reads rows of file in file order, filter_columns are only read for the filter and then dropped
+    """
+    parquet = pq.ParquetFile(file)
+    table = take_rows(parquet, rows, columns + [name for name in filter_columns or [] if name not in columns])
+    if filter is not None:
+        table = table.filter(filter)
+    return table.select(columns)
+
+def index_file(file: str, columns: list, overwrite: bool):
+    results = []
+    for column in columns:
+        if not overwrite and is_current(file, column):
+            results.append((column, None))
+            continue
+        start = time.perf_counter()
+        words, rows = build_index(file, column)
+        results.append((column, (words, rows, time.perf_counter() - start)))
+    return file, results
+
+def main(args):
+    files = sorted(glob.iglob(os.path.join(args.laion_dir, "*.parquet")))
+    columns = args.columns.split(",")
+    print(f"{Fore.CYAN}indexing {columns} of {len(files)} parquet files in {args.laion_dir}{Style.RESET_ALL}")
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for file, results in executor.map(index_file, files, [columns] * len(files), [args.overwrite] * len(files)):
+            for column, result in results:
+                if result is None:
+                    print(f"{Fore.YELLOW}  up to date: {Fore.LIGHTWHITE_EX}{index_path(file, column)}{Style.RESET_ALL}")
+                else:
+                    words, rows, seconds = result
+                    size_mb = os.path.getsize(index_path(file, column)) / 1024 / 1024
+                    print(f"{Fore.LIGHTGREEN_EX}  {index_path(file, column)}: {words} words, {rows} rows, {size_mb:0.1f} MB in {seconds:0.1f}s{Style.RESET_ALL}")
+
+if __name__ == "__main__":
+    parser = get_parser(description="Builds the inverted text index download_laion.py uses to speed up repeat searches")
+    main(parser.parse_args())
@@ -0,0 +1,216 @@
+"""
+Persistent download journal and dedup store for download_laion.py, lets a killed scrape resume without re-walking
+the output folder, and keeps duplicate images from being fetched or written twice across runs.
+
+Rows are keyed by a 64 bit hash of the URL.  On restart the hashes of every finished row are loaded once and
+anti-joined against each shard's matches, so finished rows never reach the download queue.
+"""
+import hashlib
+import sqlite3
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+SUCCESS = "success"
+FAILED = "failed" # permanent, ex. 404 or corrupt image, not retried on resume
+SKIPPED = "skipped"
+RETRY = "retry" # transient, ex. timeout or 503, retried on resume
+
+FINISHED = (SUCCESS, FAILED, SKIPPED)
+PERMANENT_HTTP_CODES = (400, 401, 403, 404, 410, 451)
+
+# query parameters that only pick a size, crop or tracking variant of the same image on common CDNs
+VARIANT_PARAMS = {"w", "h", "width", "height", "size", "resize", "fit", "crop", "q", "quality", "auto", "fm", "format",
+    "dpr", "ixlib", "ixid", "s", "ssl", "strip", "cs", "v", "ver", "version", "cache", "cb", "timestamp", "ts"}
+
+def url_hashes(urls):
+    """
+    Stable 64 bit hashes for an array of URLs, vectorized with pandas' siphash so it is the same across runs
+    """
+    if isinstance(urls, (pa.Array, pa.ChunkedArray)):
+        urls = urls.to_numpy(zero_copy_only=False)
+    return pd.util.hash_array(np.asarray(urls, dtype=object)).view(np.int64)
+
+def url_hash(url: str):
+    return int(url_hashes([url])[0])
+
+def canonical_url_hashes(urls):
+    """
+    Hashes of the canonical form of each URL, the keys DedupStore compares, slow enough per row that callers
+    should compute them off the event loop
+    """
+    return url_hashes([canonical_url(url) for url in urls])
+
+def canonical_url(url: str):
+    """
+    Normalizes a URL so trivially different links to the same image compare equal: scheme, www. prefix, default
+    ports, fragments, size/tracking query parameters and query parameter order are ignored
+    """
+    try:
+        parts = urlsplit(url.strip())
+    except ValueError:
+        return url
+    host = (parts.hostname or "").lower()
+    if host.startswith("www."):
+        host = host[4:]
+    if parts.port and parts.port not in (80, 443):
+        host = f"{host}:{parts.port}"
+    query = sorted((key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if key.lower() not in VARIANT_PARAMS and not key.lower().startswith("utm_"))
+    return urlunsplit(("", host, parts.path or "/", urlencode(query), ""))
+
+def content_hasher():
+    return hashlib.blake2b(digest_size=8)
+
+def content_hash(hasher):
+    return int.from_bytes(hasher.digest(), "little", signed=True)
+
+class DownloadJournal:
+    """
+    SQLite journal in WAL mode, writes are buffered and committed in batches to keep the event loop responsive
+    """
+    def __init__(self, path: str, batch_size: int = 256):
+        self.path = path
+        self.batch_size = batch_size
+        self.pending = []
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS downloads (
+                url_hash INTEGER PRIMARY KEY,
+                url TEXT,
+                status TEXT NOT NULL,
+                http_code INTEGER,
+                path TEXT,
+                bytes INTEGER,
+                updated REAL
+            )""")
+        self.conn.commit()
+        self.finished = self.load_finished()
+
+    def load_finished(self):
+        placeholders = ",".join("?" * len(FINISHED))
+        # url_hash is the rowid, so this comes back sorted for anti_join's binary search without a sort
+        rows = self.conn.execute(f"SELECT url_hash FROM downloads WHERE status IN ({placeholders}) ORDER BY url_hash", FINISHED)
+        return np.fromiter((row[0] for row in rows), dtype=np.int64)
+
+    def anti_join(self, table: pa.Table):
+        """
+        Drops rows of a shard that already finished in a previous run, uses the URL_HASH column if the scan added one,
+        safe to run in a thread since it only reads the finished hashes loaded at startup
+        """
+        if len(self.finished) == 0 or table.num_rows == 0:
+            return table
+        if "URL_HASH" in table.column_names:
+            hashes = table["URL_HASH"].to_numpy()
+        else:
+            hashes = url_hashes(table["URL"])
+        # a binary search of the sorted finished hashes, a hash set of millions of finished rows is too slow to build
+        # for every shard, searching in sorted order keeps it cache friendly
+        order = np.argsort(hashes)
+        found = np.searchsorted(self.finished, hashes[order])
+        finished = np.empty(len(hashes), dtype=bool)
+        finished[order] = self.finished[np.minimum(found, len(self.finished) - 1)] == hashes[order]
+        return table.filter(pa.array(~finished))
+
+    def record(self, url: str, status: str, http_code: int = None, path: str = None, nbytes: int = None):
+        self.pending.append((url_hash(url), url, status, http_code, path, nbytes, time.time()))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def failure_status(self, http_code: int):
+        return FAILED if http_code in PERMANENT_HTTP_CODES else RETRY
+
+    def flush(self):
+        if not self.pending:
+            return
+        self.conn.executemany("INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?, ?, ?, ?)", self.pending)
+        self.conn.commit()
+        self.pending = []
+
+    def counts(self):
+        self.flush()
+        return dict(self.conn.execute("SELECT status, COUNT(*) FROM downloads GROUP BY status").fetchall())
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+class DedupStore:
+    """
+    Persistent sets of canonical URL hashes and content hashes of every image already written
+    """
+    def __init__(self, path: str, batch_size: int = 256):
+        self.batch_size = batch_size
+        self.pending_urls = []
+        self.pending_contents = []
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS seen_urls (url_hash INTEGER PRIMARY KEY)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS seen_contents (content_hash INTEGER PRIMARY KEY, path TEXT)")
+        self.conn.commit()
+        self.urls = set(row[0] for row in self.conn.execute("SELECT url_hash FROM seen_urls"))
+        self.contents = dict(self.conn.execute("SELECT content_hash, path FROM seen_contents"))
+
+    def url_keys(self, urls):
+        return canonical_url_hashes(urls)
+
+    def claim_url(self, url_key: int):
+        """
+        Returns False if the canonical URL was already written or is already queued, otherwise claims it so later
+        rows with the same URL are skipped
+        """
+        if url_key in self.urls:
+            return False
+        self.urls.add(url_key)
+        return True
+
+    def claim(self, content_key: int, path: str):
+        """
+        Returns the path of an earlier image with the same content, or claims the content for path so concurrent
+        downloads of the same bytes are written once
+        """
+        duplicate = self.contents.get(content_key)
+        if duplicate is None:
+            self.contents[content_key] = path
+        return duplicate
+
+    def record(self, url: str, content_key: int, path: str):
+        self.record_url(url)
+        self.contents[content_key] = path
+        self.pending_contents.append((content_key, path))
+
+    def record_url(self, url: str):
+        url_key = int(self.url_keys([url])[0])
+        self.urls.add(url_key)
+        self.pending_urls.append((url_key,))
+        if len(self.pending_urls) >= self.batch_size:
+            self.flush()
+
+    def release_url(self, url: str):
+        """
+        Forgets a queued URL that could not be downloaded so another link to the same image can still be tried
+        """
+        self.urls.discard(int(self.url_keys([url])[0]))
+
+    def release(self, url: str, content_key: int):
+        self.release_url(url)
+        self.contents.pop(content_key, None)
+
+    def flush(self):
+        if not self.pending_urls and not self.pending_contents:
+            return
+        self.conn.executemany("INSERT OR IGNORE INTO seen_urls VALUES (?)", self.pending_urls)
+        self.conn.executemany("INSERT OR IGNORE INTO seen_contents VALUES (?, ?)", self.pending_contents)
+        self.conn.commit()
+        self.pending_urls = []
+        self.pending_contents = []
+
+    def close(self):
+        self.flush()
+        self.conn.close()
@@ -0,0 +1,169 @@
+"""
+Throughput and latency instrumentation for download_laion.py.
+
+Snapshots are written as JSON lines to --log_dir every few seconds and can be served on a local HTTP endpoint
+with --metrics_port, ex. curl http://127.0.0.1:9100/metrics
+"""
+import asyncio
+import bisect
+import collections
+import heapq
+import json
+import os
+import time
+
+from aiohttp import web
+
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10] # seconds, upper bounds, last bucket is everything slower
+TOP_HOSTS = 20 # hosts with the most requests included in each snapshot, the rest are summed up as "other"
+TRACKED_HOSTS = 1000 # hosts with their own histogram, kept to the busiest once twice this many have been seen
+
+class HostLatency:
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, latency: float):
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+        self.count += 1
+        self.total += latency
+
+    def merge(self, other: "HostLatency"):
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+        self.count += other.count
+        self.total += other.total
+
+    def percentile(self, p: float):
+        """ upper bound of the bucket holding the p-th percentile """
+        target = p * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS + [None], self.buckets):
+            seen += count
+            if seen >= target:
+                return bound
+        return None
+
+    def to_dict(self):
+        return dict(count=self.count, mean=round(self.total / self.count, 4) if self.count else None,
+            p50=self.percentile(0.5), p99=self.percentile(0.99),
+            buckets=dict(zip([str(b) for b in LATENCY_BUCKETS] + ["inf"], self.buckets)))
+
+class Metrics:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.images = 0
+        self.bytes = 0
+        self.outcomes = collections.Counter()
+        self.hosts = collections.defaultdict(HostLatency)
+        self.other_hosts = HostLatency() # hosts pruned from self.hosts
+        self.shards = []
+        self.gauges = {}
+        self.last = None
+        self.last_images = 0
+        self.last_bytes = 0
+        self.last_time = self.start
+
+    def saved(self, nbytes: int):
+        self.images += 1
+        self.bytes += nbytes
+        self.outcomes["success"] += 1
+
+    def outcome(self, cause: str):
+        self.outcomes[cause] += 1
+
+    def latency(self, host: str, seconds: float):
+        self.hosts[host].observe(seconds)
+        if len(self.hosts) > 2 * TRACKED_HOSTS:
+            self.prune_hosts()
+
+    def prune_hosts(self):
+        """ keeps the busiest hosts, a scrape sees millions of hosts and most of them only once """
+        keep = dict(heapq.nlargest(TRACKED_HOSTS, self.hosts.items(), key=lambda item: item[1].count))
+        for host, latency in self.hosts.items():
+            if host not in keep:
+                self.other_hosts.merge(latency)
+        self.hosts = collections.defaultdict(HostLatency, keep)
+
+    def gauge(self, name: str, read):
+        """ read is called at every snapshot, ex. a queue's qsize """
+        self.gauges[name] = read
+
+    def shard(self, file: str, scan_seconds: float, feed_seconds: float, matches: int, queued: int):
+        self.shards.append(dict(file=os.path.basename(file), scan_s=round(scan_seconds, 3), feed_s=round(feed_seconds, 3),
+            matches=matches, queued=queued))
+
+    def snapshot(self):
+        now = time.perf_counter()
+        interval = max(now - self.last_time, 1e-9)
+        elapsed = max(now - self.start, 1e-9)
+        top_hosts = heapq.nlargest(TOP_HOSTS, self.hosts.items(), key=lambda item: item[1].count)
+        top = {host for host, _ in top_hosts}
+        other = HostLatency()
+        other.merge(self.other_hosts)
+        for host, latency in self.hosts.items():
+            if host not in top:
+                other.merge(latency)
+        self.last = dict(
+            time=time.time(),
+            elapsed_s=round(elapsed, 3),
+            images=self.images,
+            bytes=self.bytes,
+            images_per_s=round((self.images - self.last_images) / interval, 2),
+            bytes_per_s=round((self.bytes - self.last_bytes) / interval, 1),
+            avg_images_per_s=round(self.images / elapsed, 2),
+            outcomes=dict(self.outcomes),
+            queues={name: read() for name, read in self.gauges.items()},
+            hosts={host: latency.to_dict() for host, latency in top_hosts + ([("other", other)] if other.count else [])},
+            shards=self.shards[-5:],
+        )
+        self.last_images = self.images
+        self.last_bytes = self.bytes
+        self.last_time = now
+        return self.last
+
+class MetricsReporter:
+    """
+    Writes a snapshot every interval seconds to a jsonl file in log_dir, and optionally serves the latest on port
+    """
+    def __init__(self, metrics: Metrics, log_dir: str = None, port: int = 0, interval: float = 10):
+        self.metrics = metrics
+        self.interval = interval
+        self.port = port
+        self.path = None
+        if log_dir:
+            os.makedirs(log_dir, exist_ok=True)
+            self.path = os.path.join(log_dir, f"metrics-{time.strftime('%Y%m%d-%H%M%S')}.jsonl")
+        self.task = None
+        self.runner = None
+
+    async def start(self):
+        if self.port:
+            app = web.Application()
+            app.router.add_get("/metrics", self.handle)
+            self.runner = web.AppRunner(app)
+            await self.runner.setup()
+            await web.TCPSite(self.runner, "127.0.0.1", self.port).start()
+        self.task = asyncio.create_task(self.run())
+
+    async def handle(self, request):
+        return web.json_response(self.metrics.last or self.metrics.snapshot())
+
+    def write(self):
+        snapshot = self.metrics.snapshot()
+        if self.path:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(snapshot) + "\n")
+        return snapshot
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.write()
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+        if self.runner:
+            await self.runner.cleanup()
+        return self.write()